@@ -0,0 +1,158 @@
+"""ann.py
+Approximate nearest-neighbour search for very large parallel corpora.
+Scoring a query against every line stops being cheap once several full Bibles and dictionaries are loaded.
+IVFIndex projects the sparse document vectors down to small dense sentence vectors (a count-sketch projection, so
+memory stays linear in the number of features), clusters them with spherical k-means and keeps one inverted list of
+lines per cluster; the lines are projected in row batches, so no dense copy of the whole corpus is ever held.
+A query only scores the lines of its `n_probe` closest clusters, which trades recall for latency.
+The candidates are re-scored exactly against the sparse matrix, so the scores returned are the true similarities.
+
+Run `python -m SilverPath.ann <data_dir> [retriever]` from MetaPatternModel to measure recall against exact search.
+"""
+import sys
+import time
+import numpy as np
+import scipy.sparse as sp
+
+
+class IVFIndex:
+    def __init__(self, matrix, dim: int = 128, n_lists: int = None, n_probe: int = 8, n_iter: int = 10,
+                 train_size: int = 50000, seed: int = 0, batch_size: int = 4096):
+        """
+        Builds the index over the rows of a document matrix.
+
+        Parameters:
+        matrix (scipy.sparse matrix): The document matrix, one row per reference line.
+        dim (int): The size of the dense sentence vectors.
+        n_lists (int): The number of clusters, sqrt of the number of lines by default.
+        n_probe (int): The default number of clusters scored per query.
+        n_iter (int): The number of k-means iterations.
+        train_size (int): The number of lines k-means is trained on.
+        seed (int): The seed of the projection and of the k-means initialization.
+        batch_size (int): The number of lines projected at a time while the lines are assigned to their lists.
+        """
+        self.matrix = sp.csr_matrix(matrix)
+        n_lines, n_features = self.matrix.shape
+        self.n_probe = n_probe
+        rng = np.random.default_rng(seed)
+        # count-sketch projection: every feature is added, with a random sign, to one random dimension
+        buckets = rng.integers(0, dim, size=n_features)
+        signs = rng.choice(np.array([-1.0, 1.0], dtype=np.float32), size=n_features)
+        self.projection = sp.csr_matrix((signs, (np.arange(n_features), buckets)), shape=(n_features, dim))
+
+        n_lists = n_lists or max(1, int(np.sqrt(n_lines)))
+        n_lists = min(n_lists, max(n_lines, 1))
+        sample_rows = np.sort(rng.choice(n_lines, size=min(train_size, n_lines), replace=False))
+        sample = self.project(self.matrix[sample_rows])
+        self.centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)] if n_lines else \
+            np.zeros((1, dim), dtype=np.float32)
+        for _ in range(n_iter if n_lines else 0):
+            assignment = self.nearest_lists(sample, 1)[:, 0]
+            for centroid in range(len(self.centroids)):
+                members = sample[assignment == centroid]
+                if len(members):
+                    self.centroids[centroid] = members.sum(axis=0)
+            self.centroids = self.normalize(self.centroids)
+
+        assignment = np.zeros(n_lines, dtype=np.int64)
+        for start in range(0, n_lines, batch_size):
+            assignment[start:start + batch_size] = self.nearest_lists(
+                self.project(self.matrix[start:start + batch_size]), 1)[:, 0]
+        # the lines of list c are order[offsets[c]:offsets[c + 1]]
+        self.order = np.argsort(assignment, kind="stable")
+        self.offsets = np.zeros(len(self.centroids) + 1, dtype=np.int64)
+        self.offsets[1:] = np.cumsum(np.bincount(assignment, minlength=len(self.centroids)))
+
+    @staticmethod
+    def normalize(vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        vectors /= norms
+        return vectors
+
+    def project(self, matrix) -> np.ndarray:
+        # float32 from the start, the projected rows are the only dense copy made
+        return self.normalize((sp.csr_matrix(matrix, dtype=np.float32) @ self.projection).toarray())
+
+    def nearest_lists(self, vectors: np.ndarray, n_probe: int, batch_size: int = 4096) -> np.ndarray:
+        n_probe = min(n_probe, len(self.centroids))
+        lists = np.empty((len(vectors), n_probe), dtype=np.int64)
+        for start in range(0, len(vectors), batch_size):
+            similarities = vectors[start:start + batch_size] @ self.centroids.T
+            top = np.argpartition(-similarities, n_probe - 1, axis=1)[:, :n_probe]
+            lists[start:start + batch_size] = top
+        return lists
+
+    def search(self, query_matrix, k: int, n_probe: int = None) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        Finds the approximate top k lines of each query.
+
+        Parameters:
+        query_matrix (scipy.sparse matrix): The query vectors, made by the retriever the document matrix came from.
+        k (int): The number of lines returned per query.
+        n_probe (int): The number of clusters scored per query, more is slower but closer to exact search.
+
+        Returns:
+        list: Per query, the line indexes and their exact similarities, best first. Only positive scores are kept.
+        """
+        query_matrix = sp.csr_matrix(query_matrix)
+        lists = self.nearest_lists(self.project(query_matrix), n_probe or self.n_probe)
+        results = []
+        for row, probed in enumerate(lists):
+            candidates = np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probed])
+            scores = (self.matrix[candidates] @ query_matrix[row].T).toarray().ravel()
+            positive = scores > 0
+            candidates, scores = candidates[positive], scores[positive]
+            if len(candidates) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                candidates, scores = candidates[top], scores[top]
+            order = np.lexsort((candidates, -scores))
+            results.append((candidates[order], scores[order]))
+        return results
+
+
+def exact_search(matrix, query_matrix, k: int) -> list[np.ndarray]:
+    similarities = (sp.csr_matrix(query_matrix) @ sp.csr_matrix(matrix).T).tocsr()
+    results = []
+    for row in range(similarities.shape[0]):
+        begin, end = similarities.indptr[row], similarities.indptr[row + 1]
+        lines, scores = similarities.indices[begin:end], similarities.data[begin:end]
+        if len(lines) > k:
+            lines = lines[np.argpartition(-scores, k - 1)[:k]]
+        results.append(lines)
+    return results
+
+
+def recall_at_k(index: IVFIndex, query_matrix, k: int = 10, n_probe: int = None) -> tuple[float, float]:
+    """
+    Measures the recall of the approximate search against exact search.
+
+    Returns:
+    tuple: The mean recall@k and the mean latency per query in milliseconds.
+    """
+    exact = exact_search(index.matrix, query_matrix, k)
+    start = time.perf_counter()
+    approximate = index.search(query_matrix, k, n_probe=n_probe)
+    latency = (time.perf_counter() - start) * 1000 / max(query_matrix.shape[0], 1)
+    recalls = [len(set(lines) & set(found)) / len(lines) for lines, (found, _) in zip(exact, approximate) if len(lines)]
+    return (float(np.mean(recalls)) if recalls else 1.0), latency
+
+
+if __name__ == "__main__":
+    from SilverPath.index import CorpusIndex, load_lines
+    import os
+
+    data_dir = sys.argv[1]
+    corpus = CorpusIndex(data_dir, retriever=sys.argv[2] if len(sys.argv) > 2 else "tfidf")
+    prompts = load_lines(os.path.join(data_dir, "prompts.txt"))
+    queries = corpus.retriever.transform(prompts)
+    start = time.perf_counter()
+    index = IVFIndex(corpus.matrix)
+    print(f"built {len(index.centroids)} lists over {corpus.matrix.shape[0]} lines in {time.perf_counter() - start:.2f}s")
+    start = time.perf_counter()
+    exact_search(corpus.matrix, queries, 10)
+    print(f"exact: {(time.perf_counter() - start) * 1000 / max(len(prompts), 1):.3f}ms/query")
+    for n_probe in (1, 2, 4, 8, 16, 32):
+        recall, latency = recall_at_k(index, queries, k=10, n_probe=n_probe)
+        print(f"n_probe={n_probe}: recall@10 {recall:.3f}, {latency:.3f}ms/query")
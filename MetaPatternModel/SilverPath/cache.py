@@ -0,0 +1,109 @@
+"""cache.py
+Memoization of silver ranks.
+A rank only depends on the set of words in the prompt and on the reference corpus, so ranks are keyed by the
+normalized prompt together with a fingerprint of the corpus. Entries live in a bounded LRU and can optionally be
+appended to a jsonl file, so the same ranks are reused across the prompt sort, the translation loop and restarts.
+The file is rewritten with only the entries the LRU holds when it is loaded and whenever it grows past twice the
+LRU size, so entries of old corpus versions do not pile up in it and get parsed on every startup.
+"""
+import json
+import os
+from collections import OrderedDict
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    Normalizes a prompt to the part of it a silver rank depends on: its set of words.
+
+    Parameters:
+    prompt (str): The prompt to normalize.
+
+    Returns:
+    str: The sorted, de-duplicated words of the prompt.
+    """
+    return ' '.join(sorted(set(prompt.split())))
+
+
+class RankCache:
+    def __init__(self, max_size: int = 4096, path: str = None):
+        """
+        Initializes the cache, loading previously persisted ranks if a path is given.
+
+        Parameters:
+        max_size (int): The maximum number of ranks held in memory.
+        path (str): Optional jsonl file the ranks are persisted to.
+        """
+        self.max_size = max_size
+        self.path = path
+        self.entries = OrderedDict()
+        self._lines = 0
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self) -> None:
+        with open(self.path, "r") as file:
+            for line in file:
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    # a partially written last line from an interrupted run
+                    continue
+                self._remember((data["fingerprint"], data["prompt"]), data["rank"])
+                self._lines += 1
+        if self._lines > len(self.entries):
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        Rewrites the cache file with only the entries held in memory.
+        Ranks another process appends while the file is rewritten may be lost, which only costs recomputing them.
+        """
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as file:
+            for (fingerprint, prompt), rank in self.entries.items():
+                file.write(json.dumps({"fingerprint": fingerprint, "prompt": prompt, "rank": rank}) + "\n")
+        os.replace(temporary, self.path)
+        self._lines = len(self.entries)
+
+    def get(self, prompt: str, fingerprint: str):
+        """
+        Looks up the rank of a prompt, returning None when it is not cached.
+        """
+        key = (fingerprint, normalize_prompt(prompt))
+        rank = self.entries.get(key)
+        if rank is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return rank
+
+    def put(self, prompt: str, fingerprint: str, rank: int) -> None:
+        """
+        Stores the rank of a prompt, appending it to the cache file if there is one.
+        """
+        key = (fingerprint, normalize_prompt(prompt))
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self._remember(key, rank)
+        if self.path is not None:
+            with open(self.path, "a") as file:
+                file.write(json.dumps({"fingerprint": key[0], "prompt": key[1], "rank": rank}) + "\n")
+            self._lines += 1
+            if self._lines > 2 * self.max_size:
+                self.compact()
+
+    def _remember(self, key: tuple[str, str], rank: int) -> None:
+        self.entries[key] = rank
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __str__(self):
+        return f"RankCache: {len(self.entries)} ranks, {self.hits} hits, {self.misses} misses."
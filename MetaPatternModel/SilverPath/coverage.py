@@ -0,0 +1,135 @@
+"""coverage.py
+Greedy coverage engine behind the silver rank.
+The silver rank of a query is the number of greedy steps needed to cover its words: each step picks the
+reference line most similar to the words that are still uncovered, then removes that line's words from the query.
+Rather than scoring every reference line on every step, the engine keeps a feature -> posting list inverted index
+(the columns of the retriever's document matrix) and only ever touches the lines that share an uncovered word.
+Scores are updated incrementally as words get covered.
+"""
+import numpy as np
+
+
+class CoverageIndex:
+    def __init__(self, source_texts: list[str], source_matrix, retriever):
+        """
+        Builds the inverted index from an already fitted retriever.
+
+        Parameters:
+        source_texts (list): The reference lines, one per row of source_matrix.
+        source_matrix (scipy.sparse matrix): The document matrix of source_texts.
+        retriever (Retriever): The retriever source_matrix was built with.
+        """
+        self.source_texts = source_texts
+        postings = source_matrix.tocsc()
+        postings.sort_indices()
+        self.indptr = postings.indptr
+        self.indices = postings.indices
+        self.data = postings.data
+        self.weights = retriever.weights
+        self.retriever = retriever
+
+    def word_features(self, word: str) -> list[int]:
+        """
+        Returns the feature ids the retriever extracts from a query word, with repetitions.
+        """
+        return self.retriever.analyze(word)
+
+    def posting(self, feature: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the rows containing a feature together with their document weights.
+        """
+        start, end = self.indptr[feature], self.indptr[feature + 1]
+        return self.indices[start:end], self.data[start:end]
+
+    def rank(self, query: str, max_rank: int) -> int:
+        """
+        Computes the silver rank of a query.
+
+        Parameters:
+        query (str): The normalized query text.
+        max_rank (int): The maximum number of greedy steps.
+
+        Returns:
+        int: The silver rank of the query.
+        """
+        query_words = set(query.split())
+        word_features = {word: self.word_features(word) for word in query_words}
+        counts = {}
+        for features in word_features.values():
+            for feature in features:
+                counts[feature] = counts.get(feature, 0) + 1
+
+        # the query vector is count * weight over the uncovered words; its norm is shared by every line,
+        # so the un-normalized dot product ranks lines exactly like the normalized similarity does
+        if counts:
+            postings = [self.posting(feature) for feature in counts]
+            rows = np.concatenate([rows for rows, _ in postings])
+            weights = np.concatenate([counts[feature] * self.weights[feature] * data
+                                      for feature, (_, data) in zip(counts, postings)])
+            candidates, inverse = np.unique(rows, return_inverse=True)
+            scores = np.bincount(inverse, weights=weights, minlength=len(candidates))
+            # number of uncovered features each candidate still shares with the query
+            live = np.bincount(inverse, minlength=len(candidates))
+        else:
+            candidates = np.zeros(0, dtype=np.int64)
+            scores = np.zeros(0)
+            live = np.zeros(0, dtype=np.int64)
+
+        rank = 0
+        previous_similar_words = None
+        while query_words and rank < max_rank:
+            # with nothing left to match every similarity is zero and argmax falls back to the first line
+            best = np.argmax(scores) if len(scores) else None
+            most_similar_index = candidates[best] if best is not None and scores[best] > 0 else 0
+            similar_words = set(self.source_texts[most_similar_index].split())
+            if similar_words == previous_similar_words:
+                rank *= len(similar_words)
+                break
+            previous_similar_words = similar_words
+            for word in query_words & similar_words:
+                for feature in word_features[word]:
+                    counts[feature] -= 1
+                    rows, data = self.posting(feature)
+                    positions = np.searchsorted(candidates, rows)
+                    scores[positions] -= self.weights[feature] * data
+                    if counts[feature] == 0:
+                        live[positions] -= 1
+                        # pin fully covered lines to an exact zero so rounding leftovers are never picked
+                        scores[positions[live[positions] == 0]] = 0.0
+            query_words -= similar_words
+            rank += 1
+        return rank
+
+
+class ApproximateCoverage:
+    def __init__(self, source_texts: list[str], retriever, ann_index, n_probe: int = None):
+        """
+        The same greedy coverage as CoverageIndex, with each step answered by an approximate nearest-neighbour index.
+
+        Parameters:
+        source_texts (list): The reference lines the ANN index was built over.
+        retriever (Retriever): The retriever the indexed document matrix was built with.
+        ann_index (IVFIndex): The approximate nearest-neighbour index.
+        n_probe (int): The number of clusters scored per step, the index default if None.
+        """
+        self.source_texts = source_texts
+        self.retriever = retriever
+        self.ann_index = ann_index
+        self.n_probe = n_probe
+
+    def rank(self, query: str, max_rank: int) -> int:
+        query_words = set(query.split())
+        rank = 0
+        previous_similar_words = None
+        while query_words and rank < max_rank:
+            query_vector = self.retriever.transform([' '.join(query_words)])
+            (lines, _), = self.ann_index.search(query_vector, 1, n_probe=self.n_probe)
+            most_similar_index = lines[0] if len(lines) else 0
+            similar_words = set(self.source_texts[most_similar_index].split())
+            if similar_words == previous_similar_words:
+                rank *= len(similar_words)
+                break
+            previous_similar_words = similar_words
+            query_words -= similar_words
+            rank += 1
+        return rank
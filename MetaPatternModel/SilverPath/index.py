@@ -0,0 +1,209 @@
+"""index.py
+On-disk retrieval index shared by SilverPath and Translator.
+Normalizing source.txt/target.txt and fitting a retriever on them is paid once: the normalized lines,
+the vocabulary, the idf weights and the CSR document-term matrix are written next to the corpus and the arrays
+are memory-mapped on later runs. The index is rebuilt whenever the hash of either corpus file or the retriever
+settings change. Each retriever backend gets its own index directory, with one subdirectory per corpus version.
+A version is built in a temporary directory and renamed into place, so workers building the same index at the same
+time never write to files another worker has memory-mapped; the first rename wins and the others are discarded.
+"""
+import os
+import json
+import shutil
+import string
+import hashlib
+import tempfile
+import numpy as np
+import scipy.sparse as sp
+from SilverPath.retrievers import Retriever, make_retriever
+
+INDEX_VERSION = 3
+
+
+def load_lines(file_path: str) -> list[str]:
+    with open(file_path, "r") as file:
+        return [line.strip().lower().translate(str.maketrans('', '', string.punctuation)) for line in file]
+
+
+def file_hash(file_path: str) -> str:
+    digest = hashlib.sha1()
+    with open(file_path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CorpusIndex:
+    def __init__(self, data_dir: str, index_dir: str = ".index", retriever="tfidf"):
+        """
+        Points the index at a corpus; nothing is read until one of the properties is first used.
+
+        Parameters:
+        data_dir (str): The directory containing source.txt and target.txt.
+        index_dir (str): The directory, relative to data_dir, the index artifacts are stored in.
+        retriever (str or Retriever): The retrieval backend, or the name of one in retrievers.RETRIEVERS.
+        """
+        self.data_dir = data_dir
+        self._retriever = make_retriever(retriever)
+        self.index_dir = os.path.join(data_dir, index_dir, self._retriever.name)
+        self._hashes = None
+        self._fingerprint = None
+        self._source_texts = None
+        self._target_texts = None
+        self._matrix = None
+
+    @property
+    def hashes(self) -> dict:
+        if self._hashes is None:
+            self._hashes = {name: file_hash(os.path.join(self.data_dir, name)) for name in ("source.txt", "target.txt")}
+        return self._hashes
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Identifies the corpus version, without loading the corpus itself.
+        """
+        if self._fingerprint is None:
+            self._fingerprint = self.version
+        return self._fingerprint
+
+    @property
+    def version(self) -> str:
+        """
+        Identifies the corpus files and retriever settings the on-disk index is built from.
+        Unlike the fingerprint, it does not change when pairs are added in memory.
+        """
+        key = {"hashes": self.hashes, "retriever": self._retriever.name, "params": self._retriever.params()}
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+    @property
+    def version_dir(self) -> str:
+        return os.path.join(self.index_dir, f"v{INDEX_VERSION}-{self.version}")
+
+    @property
+    def source_texts(self) -> list[str]:
+        self.load()
+        return self._source_texts
+
+    @property
+    def target_texts(self) -> list[str]:
+        self.load()
+        return self._target_texts
+
+    @property
+    def retriever(self) -> Retriever:
+        self.load()
+        return self._retriever
+
+    @property
+    def matrix(self) -> sp.csr_matrix:
+        self.load()
+        return self._matrix
+
+    def load(self) -> None:
+        """
+        Loads the index from disk, building and saving it first if it is missing or stale.
+        """
+        if self._matrix is not None:
+            return
+        if not self._load_artifacts():
+            self.build()
+            self.save()
+
+    def build(self) -> None:
+        self._source_texts = load_lines(os.path.join(self.data_dir, "source.txt"))
+        self._target_texts = load_lines(os.path.join(self.data_dir, "target.txt"))
+        self._retriever.fit(self._source_texts)
+        self._matrix = self._retriever.transform_documents(self._source_texts)
+
+    def save(self) -> None:
+        os.makedirs(self.index_dir, exist_ok=True)
+        build_dir = tempfile.mkdtemp(prefix=".build-", dir=self.index_dir)
+        try:
+            self._write_artifacts(build_dir)
+            try:
+                os.rename(build_dir, self.version_dir)
+            except OSError:
+                # another worker saved the same version first, its artifacts are identical
+                if not os.path.exists(os.path.join(self.version_dir, "meta.json")):
+                    raise
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+        current = os.path.basename(self.version_dir)
+        for name in os.listdir(self.index_dir):
+            # earlier versions; workers that still have them memory-mapped keep reading the unlinked files
+            if name == current or name.startswith(".build-"):
+                continue
+            path = os.path.join(self.index_dir, name)
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _write_artifacts(self, directory: str) -> None:
+        for name, lines in (("source.txt", self._source_texts), ("target.txt", self._target_texts)):
+            with open(os.path.join(directory, name), "w") as file:
+                file.write("\n".join(lines))
+        vocabulary, arrays = self._retriever.get_state()
+        with open(os.path.join(directory, "vocabulary.json"), "w") as file:
+            json.dump(vocabulary, file, ensure_ascii=False)
+        for name, array in arrays.items():
+            np.save(os.path.join(directory, f"retriever_{name}.npy"), array)
+        for name in ("data", "indices", "indptr"):
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self._matrix, name))
+        meta = {"version": INDEX_VERSION, "hashes": self.hashes, "shape": list(self._matrix.shape),
+                "retriever": self._retriever.name, "params": self._retriever.params(), "arrays": sorted(arrays)}
+        with open(os.path.join(directory, "meta.json"), "w") as file:
+            json.dump(meta, file)
+
+    def _load_artifacts(self) -> bool:
+        try:
+            return self._read_artifacts(self.version_dir)
+        except FileNotFoundError:
+            # missing, or removed by a worker that saved a newer version in the meantime
+            return False
+
+    def _read_artifacts(self, directory: str) -> bool:
+        with open(os.path.join(directory, "meta.json"), "r") as file:
+            meta = json.load(file)
+        if meta.get("version") != INDEX_VERSION or meta.get("hashes") != self.hashes:
+            return False
+        if meta.get("retriever") != self._retriever.name or meta.get("params") != self._retriever.params():
+            return False
+        texts = []
+        for name in ("source.txt", "target.txt"):
+            with open(os.path.join(directory, name), "r") as file:
+                content = file.read()
+            texts.append(content.split("\n") if meta["shape"][0] else [])
+        self._source_texts, self._target_texts = texts
+        with open(os.path.join(directory, "vocabulary.json"), "r") as file:
+            vocabulary = json.load(file)
+        arrays = {name: np.load(os.path.join(directory, f"retriever_{name}.npy"), mmap_mode="r")
+                  for name in meta["arrays"]}
+        self._retriever.set_state(vocabulary, arrays)
+        data, indices, indptr = (np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                                 for name in ("data", "indices", "indptr"))
+        self._matrix = sp.csr_matrix((data, indices, indptr), shape=tuple(meta["shape"]), copy=False)
+        return True
+
+    def add_pairs(self, source_texts: list[str], target_texts: list[str]) -> None:
+        """
+        Appends source/target pairs in memory, vectorized with the already fitted retriever.
+        The on-disk index is left untouched, it always mirrors the corpus files.
+        """
+        assert len(source_texts) == len(target_texts), "The texts must have the same lengths"
+        if not source_texts:
+            return
+        self.load()
+        self._source_texts = self._source_texts + list(source_texts)
+        self._target_texts = self._target_texts + list(target_texts)
+        new_rows = self._retriever.transform_documents(source_texts)
+        self._matrix = sp.vstack([self._matrix, new_rows], format="csr")
+        digest = hashlib.sha1(self.fingerprint.encode("utf-8"))
+        for line in source_texts:
+            digest.update(line.encode("utf-8"))
+            digest.update(b"\n")
+        self._fingerprint = digest.hexdigest()
@@ -0,0 +1,263 @@
+"""retrievers.py
+Pluggable retrieval backends for SilverPath and Translator.
+A retriever turns reference lines into a sparse document matrix and queries into sparse query vectors, so that the
+similarity of every line to a query is one sparse product. It also exposes how a query word maps onto features and
+how much each feature weighs, which is what the greedy coverage engine needs to update scores incrementally.
+- TfidfRetriever: the original TF-IDF over sklearn's word tokens.
+- BM25Retriever: Okapi BM25 over whitespace words, with a bounded vocabulary.
+- CharNgramRetriever: TF-IDF over hashed character n-grams, which copes better with rich morphology.
+"""
+import zlib
+import numpy as np
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+
+def count_matrix(rows: list[list[int]], n_features: int) -> sp.csr_matrix:
+    """
+    Builds a csr matrix of feature counts from the feature ids of each row.
+    """
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(row) for row in rows])
+    indices = np.fromiter((feature for row in rows for feature in row), dtype=np.int32, count=indptr[-1])
+    data = np.ones(len(indices), dtype=np.float64)
+    matrix = sp.csr_matrix((data, indices, indptr), shape=(len(rows), n_features))
+    matrix.sum_duplicates()
+    return matrix
+
+
+def l2_normalize(matrix: sp.csr_matrix) -> sp.csr_matrix:
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sp.csr_matrix(sp.diags(1.0 / norms) @ matrix)
+
+
+class Retriever:
+    """
+    Base class of the retrieval backends.
+    Subclasses set `name` and implement fit, transform_documents, transform, analyze, weights and the state methods.
+    """
+    name = None
+
+    def fit(self, texts: list[str]) -> "Retriever":
+        """
+        Learns the corpus statistics (vocabulary, idf, ...) from the reference lines.
+        """
+        raise NotImplementedError
+
+    def transform_documents(self, texts: list[str]) -> sp.csr_matrix:
+        """
+        Vectorizes reference lines into rows of the document matrix.
+        """
+        raise NotImplementedError
+
+    def transform(self, texts: list[str]) -> sp.csr_matrix:
+        """
+        Vectorizes queries; the product with the document matrix gives their similarity to every line.
+        """
+        raise NotImplementedError
+
+    def analyze(self, text: str) -> list[int]:
+        """
+        Returns the feature ids of a text, with repetitions. Features the retriever does not know are dropped.
+        """
+        raise NotImplementedError
+
+    @property
+    def weights(self) -> np.ndarray:
+        """
+        The query-side weight of one occurrence of each feature.
+        """
+        raise NotImplementedError
+
+    def params(self) -> dict:
+        """
+        The json-serializable settings of the retriever; an index built with other settings is rebuilt.
+        """
+        raise NotImplementedError
+
+    def get_state(self) -> tuple[list, dict]:
+        """
+        Returns the fitted vocabulary (or None) and the fitted arrays, for persisting.
+        """
+        raise NotImplementedError
+
+    def set_state(self, vocabulary: list, arrays: dict) -> "Retriever":
+        raise NotImplementedError
+
+
+class TfidfRetriever(Retriever):
+    name = "tfidf"
+
+    def __init__(self):
+        self.vectorizer = TfidfVectorizer()
+        self._analyzer = None
+
+    def fit(self, texts):
+        self.vectorizer.fit(texts)
+        return self
+
+    def transform_documents(self, texts):
+        # rows are l2-normalized by the vectorizer, so dot products against them are cosine similarities
+        return self.vectorizer.transform(texts).tocsr()
+
+    def transform(self, texts):
+        return self.vectorizer.transform(texts)
+
+    def analyze(self, text):
+        if self._analyzer is None:
+            self._analyzer = self.vectorizer.build_analyzer()
+        vocabulary = self.vectorizer.vocabulary_
+        return [vocabulary[token] for token in self._analyzer(text) if token in vocabulary]
+
+    @property
+    def weights(self):
+        return self.vectorizer.idf_
+
+    def params(self):
+        return {}
+
+    def get_state(self):
+        vocabulary = sorted(self.vectorizer.vocabulary_, key=self.vectorizer.vocabulary_.get)
+        return vocabulary, {"idf": self.vectorizer.idf_}
+
+    def set_state(self, vocabulary, arrays):
+        self.vectorizer = TfidfVectorizer(vocabulary={term: i for i, term in enumerate(vocabulary)})
+        self.vectorizer.idf_ = np.asarray(arrays["idf"])
+        self._analyzer = None
+        return self
+
+
+class BM25Retriever(Retriever):
+    name = "bm25"
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, max_features: int = 1_000_000):
+        """
+        Parameters:
+        k1 (float): The term frequency saturation.
+        b (float): The strength of the document length normalization.
+        max_features (int): The vocabulary bound, the most frequent words are kept.
+        """
+        self.k1 = k1
+        self.b = b
+        self.max_features = max_features
+        self.vocabulary = {}
+        self.idf = np.zeros(0)
+        self.avgdl = 0.0
+
+    def fit(self, texts):
+        document_frequency = {}
+        total_length = 0
+        for text in texts:
+            words = text.split()
+            total_length += len(words)
+            for word in set(words):
+                document_frequency[word] = document_frequency.get(word, 0) + 1
+        words = sorted(document_frequency, key=lambda word: (-document_frequency[word], word))[:self.max_features]
+        self.vocabulary = {word: i for i, word in enumerate(words)}
+        df = np.array([document_frequency[word] for word in words], dtype=np.float64)
+        n = len(texts)
+        self.idf = np.log(1.0 + (n - df + 0.5) / (df + 0.5))
+        self.avgdl = total_length / n if n else 0.0
+        return self
+
+    def transform_documents(self, texts):
+        counts = count_matrix([self.analyze(text) for text in texts], len(self.vocabulary))
+        lengths = np.array([len(text.split()) for text in texts], dtype=np.float64)
+        avgdl = self.avgdl or 1.0
+        # tf * (k1 + 1) / (tf + k1 * (1 - b + b * |d| / avgdl)), applied to the stored counts only
+        norm = self.k1 * (1.0 - self.b + self.b * lengths / avgdl)
+        row_norm = np.repeat(norm, np.diff(counts.indptr))
+        counts.data = counts.data * (self.k1 + 1.0) / (counts.data + row_norm)
+        return counts
+
+    def transform(self, texts):
+        counts = count_matrix([self.analyze(text) for text in texts], len(self.vocabulary))
+        return sp.csr_matrix(counts @ sp.diags(self.idf))
+
+    def analyze(self, text):
+        return [self.vocabulary[word] for word in text.split() if word in self.vocabulary]
+
+    @property
+    def weights(self):
+        return self.idf
+
+    def params(self):
+        return {"k1": self.k1, "b": self.b, "max_features": self.max_features}
+
+    def get_state(self):
+        vocabulary = sorted(self.vocabulary, key=self.vocabulary.get)
+        return vocabulary, {"idf": self.idf, "avgdl": np.array([self.avgdl])}
+
+    def set_state(self, vocabulary, arrays):
+        self.vocabulary = {word: i for i, word in enumerate(vocabulary)}
+        self.idf = np.asarray(arrays["idf"])
+        self.avgdl = float(arrays["avgdl"][0])
+        return self
+
+
+class CharNgramRetriever(Retriever):
+    name = "char"
+
+    def __init__(self, ngram_range: tuple[int, int] = (2, 4), n_features: int = 2 ** 18):
+        """
+        Parameters:
+        ngram_range (tuple): The smallest and largest n-gram size, taken within space padded words.
+        n_features (int): The number of hash buckets, which bounds the memory of the backend.
+        """
+        self.ngram_range = tuple(ngram_range)
+        self.n_features = n_features
+        self.idf = np.ones(n_features)
+
+    def fit(self, texts):
+        document_frequency = np.zeros(self.n_features)
+        for text in texts:
+            document_frequency[list(set(self.analyze(text)))] += 1
+        # the same smoothed idf sklearn uses
+        self.idf = np.log((1.0 + len(texts)) / (1.0 + document_frequency)) + 1.0
+        return self
+
+    def transform_documents(self, texts):
+        return self.transform(texts)
+
+    def transform(self, texts):
+        counts = count_matrix([self.analyze(text) for text in texts], self.n_features)
+        return l2_normalize(sp.csr_matrix(counts @ sp.diags(self.idf)))
+
+    def analyze(self, text):
+        # crc32 rather than hash(), which is salted per process and would not survive persisting
+        low, high = self.ngram_range
+        features = []
+        for word in text.split():
+            padded = f" {word} "
+            for n in range(low, high + 1):
+                for i in range(len(padded) - n + 1):
+                    features.append(zlib.crc32(padded[i:i + n].encode("utf-8")) % self.n_features)
+        return features
+
+    @property
+    def weights(self):
+        return self.idf
+
+    def params(self):
+        return {"ngram_range": list(self.ngram_range), "n_features": self.n_features}
+
+    def get_state(self):
+        return None, {"idf": self.idf}
+
+    def set_state(self, vocabulary, arrays):
+        self.idf = np.asarray(arrays["idf"])
+        return self
+
+
+RETRIEVERS = {retriever.name: retriever for retriever in (TfidfRetriever, BM25Retriever, CharNgramRetriever)}
+
+
+def make_retriever(retriever) -> Retriever:
+    """
+    Returns a retriever from either a Retriever instance or the name of a backend in RETRIEVERS.
+    """
+    if isinstance(retriever, Retriever):
+        return retriever
+    assert retriever in RETRIEVERS, f"Unknown retriever {retriever}, expected one of {list(RETRIEVERS)}"
+    return RETRIEVERS[retriever]()
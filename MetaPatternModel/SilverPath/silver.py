@@ -6,55 +6,172 @@ as well as a means of determining which materials might be highest priority.
 import os
 import json
 import string
-from sklearn.feature_extraction.text import TfidfVectorizer
-import numpy as np
+import hashlib
+import multiprocessing
 import tqdm
+from SilverPath.coverage import CoverageIndex, ApproximateCoverage
+from SilverPath.ann import IVFIndex
+from SilverPath.cache import RankCache
+from SilverPath.index import CorpusIndex
+from SilverPath.retrievers import Retriever
+
+# read-only state of a ranking worker process, set once by _init_worker
+_worker_ranker = None
+_worker_max_rank = None
+
+
+def _init_worker(ranker, max_rank: int) -> None:
+    global _worker_ranker, _worker_max_rank
+    _worker_ranker = ranker
+    _worker_max_rank = max_rank
+
+
+def _rank_worker(item: tuple[int, str]) -> tuple[int, int]:
+    index, prompt = item
+    return index, _worker_ranker.rank(prompt, _worker_max_rank)
+
 
 class SilverPath:
-    def __init__(self, data_dir: str, max_rank: int = 100):
+    def __init__(self, data_dir: str, max_rank: int = 100, cache_size: int = 4096, cache_file: str = None,
+                 index: CorpusIndex = None, retriever="tfidf", ann: bool = False, n_probe: int = 8):
         self.data_dir = data_dir
-        self.source_texts = self.load_text_file("source.txt")
-        self.target_texts = self.load_text_file("target.txt")
+        # the corpus, its retriever and the CSR matrix are loaded lazily from the persisted index
+        self.index = index if index is not None else CorpusIndex(data_dir, retriever=retriever)
         self.prompts = self.load_text_file("prompts.txt")
         self.max_rank = max_rank
-        self.vectorizer = TfidfVectorizer()
-        self.vectorizer.fit(self.source_texts)
+        # answer each greedy step from an approximate nearest-neighbour index instead of the exact inverted index,
+        # n_probe trades recall for latency
+        self.ann = ann
+        self.n_probe = n_probe
+        self._coverage = None
+        self._ann_index = None
+        self._fingerprint = None
+        cache_path = os.path.join(data_dir, cache_file) if cache_file is not None else None
+        self.rank_cache = RankCache(max_size=cache_size, path=cache_path)
+
+    @property
+    def source_texts(self) -> list[str]:
+        return self.index.source_texts
+
+    @property
+    def target_texts(self) -> list[str]:
+        return self.index.target_texts
+
+    @property
+    def retriever(self) -> Retriever:
+        return self.index.retriever
+
+    @property
+    def source_matrix(self):
+        # a single sparse matrix-vector product scores the query against every line
+        return self.index.matrix
 
     def load_text_file(self, file_name: str) -> list[str]:
         file_path = os.path.join(self.data_dir, file_name)
         with open(file_path, "r") as file:
             return [line.strip().lower().translate(str.maketrans('', '', string.punctuation)) for line in file]
     
+    @property
+    def coverage(self) -> CoverageIndex:
+        if self._coverage is None:
+            self._coverage = CoverageIndex(self.source_texts, self.source_matrix, self.retriever)
+        return self._coverage
+
+    @property
+    def ann_index(self) -> IVFIndex:
+        if self._ann_index is None:
+            self._ann_index = IVFIndex(self.source_matrix, n_probe=self.n_probe)
+        return self._ann_index
+
+    @property
+    def ranker(self):
+        if self.ann:
+            return ApproximateCoverage(self.source_texts, self.retriever, self.ann_index, self.n_probe)
+        return self.coverage
+
+    @property
+    def fingerprint(self) -> str:
+        """
+        Identifies the corpus version a rank was computed against.
+        """
+        if self._fingerprint is None:
+            key = f"{self.max_rank}:{self.index.fingerprint}" + (f":ann{self.n_probe}" if self.ann else "")
+            self._fingerprint = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return self._fingerprint
+
     def search(self, query: str) -> int:
-        query_words = set(query.split())
-        rank = 0
-        previous_similar_words = None
-        while query_words and rank < self.max_rank:
-            query_vector = self.vectorizer.transform([' '.join(query_words)])
-            cosine_similarities = np.dot(query_vector, self.vectorizer.transform(self.source_texts).T).toarray().flatten()            
-            most_similar_index = np.argmax(cosine_similarities)
-            similar_words = set(self.source_texts[most_similar_index].split())
-            if similar_words == previous_similar_words:
-                rank *= len(similar_words)
-                break
-            previous_similar_words = similar_words
-            query_words -= similar_words
-            rank += 1
+        rank = self.rank_cache.get(query, self.fingerprint)
+        if rank is None:
+            rank = self.ranker.rank(query, self.max_rank)
+            self.rank_cache.put(query, self.fingerprint, rank)
         return rank
-    def order_prompts_based_on_rank(self):
-        ranked_prompts = sorted(self.prompts, key=lambda prompt: self.search(prompt), reverse=True)
+
+    def add_pairs(self, source_texts: list[str], target_texts: list[str]) -> None:
+        """
+        Appends new source/target pairs to the reference corpus. The new lines are
+        vectorized with the already fitted retriever instead of refitting,
+        so words unseen at construction time do not contribute to the search.
+        """
+        self.index.add_pairs(source_texts, target_texts)
+        self._coverage = None
+        self._ann_index = None
+        self._fingerprint = None
+
+    def rank_many(self, prompts: list[str], processes: int = None, chunksize: int = 64):
+        """
+        Computes the silver rank of many prompts, yielding (index, rank) tuples as soon as they are ready.
+
+        Parameters:
+        prompts (list): The prompts to rank.
+        processes (int): The number of worker processes, None or 1 ranks in the current process.
+        chunksize (int): The number of prompts handed to a worker at a time.
+
+        Yields:
+        tuple: The index of the prompt in prompts and its rank, in completion order.
+        """
+        if processes is None or processes <= 1:
+            for index, prompt in enumerate(prompts):
+                yield index, self.search(prompt)
+            return
+        misses = []
+        for index, prompt in enumerate(prompts):
+            rank = self.rank_cache.get(prompt, self.fingerprint)
+            if rank is None:
+                misses.append((index, prompt))
+            else:
+                yield index, rank
+        if not misses:
+            return
+        # forked workers inherit the ranker and its index copy-on-write, so the corpus matrix is shared rather than
+        # pickled per worker; fork is asked for explicitly as it is not the default on macOS (spawn) or from
+        # python 3.14 on (forkserver). Where there is no fork (Windows), every worker gets a pickled copy.
+        start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+        context = multiprocessing.get_context(start_method)
+        with context.Pool(processes, initializer=_init_worker, initargs=(self.ranker, self.max_rank)) as pool:
+            for index, rank in pool.imap_unordered(_rank_worker, misses, chunksize=chunksize):
+                self.rank_cache.put(prompts[index], self.fingerprint, rank)
+                yield index, rank
+
+    def order_prompts_based_on_rank(self, processes: int = None):
+        ranks = [0] * len(self.prompts)
+        for index, rank in self.rank_many(self.prompts, processes=processes):
+            ranks[index] = rank
+        # stable, so prompts with the same rank keep their original order
+        order = sorted(range(len(self.prompts)), key=lambda index: ranks[index], reverse=True)
+        ranked_prompts = [self.prompts[index] for index in order]
         return ranked_prompts
-    def rank_prompts(self) -> None:
+
+    def rank_prompts(self, processes: int = None) -> None:
         output_file = os.path.join(self.data_dir, "ranked_prompts.jsonl")
         with open(output_file, "w") as file:
-            for prompt in tqdm.tqdm(self.prompts):
-                rank = self.search(prompt)
-                data = {"prompt": prompt, "rank": rank, "index": self.prompts.index(prompt)}
+            for index, rank in tqdm.tqdm(self.rank_many(self.prompts, processes=processes), total=len(self.prompts)):
+                data = {"prompt": self.prompts[index], "rank": rank, "index": index}
                 file.write(json.dumps(data) + "\n")
-
+                file.flush()
 
 if __name__ == "__main__":
     # Usage
     data_dir = "/Users/daniellosey/Desktop/code/biblica/pattern model/languages"
+    # run from MetaPatternModel as `python -m SilverPath.silver`
     silver_path = SilverPath(data_dir)
     silver_path.rank_prompts()
\ No newline at end of file
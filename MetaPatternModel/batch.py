@@ -0,0 +1,202 @@
+"""batch.py
+Batch submission for offline bulk translation.
+Overnight runs over a whole book do not need interactive latency. All requests are written to one jsonl request
+file, submitted through a provider's batch interface and polled until the batch has ended; the results are then
+matched back to the requests by their custom_id.
+Each line of a request file is {"custom_id", "model", "system", "message", "stable_prefix", "params"}, and a
+provider adapter turns it into whatever its batch API expects. FileBatchProvider is a local, file-based fake.
+"""
+import os
+import json
+import time
+import uuid
+
+
+def write_requests(path: str, requests: list[dict]) -> None:
+    with open(path, "w") as file:
+        for request in requests:
+            file.write(json.dumps(request, ensure_ascii=False) + "\n")
+
+
+def read_requests(path: str) -> list[dict]:
+    with open(path, "r") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+class BatchProvider:
+    """
+    Adapter to a provider's batch interface.
+    """
+    def submit(self, request_file: str) -> str:
+        """
+        Submits a request file, returning the id of the batch.
+        """
+        raise NotImplementedError
+
+    def done(self, batch_id: str) -> bool:
+        """
+        Whether the batch has ended, successfully or not.
+        """
+        raise NotImplementedError
+
+    def results(self, batch_id: str) -> dict:
+        """
+        Returns a dict of custom_id to {"text": output} or {"error": description} for every finished request.
+        Requests missing from it count as failed.
+        """
+        raise NotImplementedError
+
+
+class AnthropicBatchProvider(BatchProvider):
+    def __init__(self, client):
+        """
+        Parameters:
+        client (anthropic.Client): The client to submit with, e.g. transport.get_client("anthropic", key).
+        """
+        self.client = client
+
+    def submit(self, request_file):
+        requests = []
+        for request in read_requests(request_file):
+            content = request["message"]
+            prefix = request.get("stable_prefix")
+            if prefix and content.startswith(prefix):
+                content = [
+                    {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}},
+                    {"type": "text", "text": content[len(prefix):]},
+                ]
+            params = dict(model=request["model"], system=request["system"],
+                          messages=[{"role": "user", "content": content}], **request["params"])
+            requests.append({"custom_id": request["custom_id"], "params": params})
+        return self.client.messages.batches.create(requests=requests).id
+
+    def done(self, batch_id):
+        return self.client.messages.batches.retrieve(batch_id).processing_status == "ended"
+
+    def results(self, batch_id):
+        results = {}
+        for entry in self.client.messages.batches.results(batch_id):
+            if entry.result.type == "succeeded":
+                results[entry.custom_id] = {"text": entry.result.message.content[0].text}
+            else:
+                results[entry.custom_id] = {"error": entry.result.type}
+        return results
+
+
+class OpenAIBatchProvider(BatchProvider):
+    def __init__(self, client):
+        """
+        Parameters:
+        client (openai.OpenAI): The client to submit with, e.g. transport.get_client("openai", key).
+        """
+        self.client = client
+
+    def submit(self, request_file):
+        upload_file = request_file + ".openai"
+        write_requests(upload_file, [{
+            "custom_id": request["custom_id"],
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": dict(model=request["model"], messages=[
+                {"role": "system", "content": request["system"]},
+                {"role": "user", "content": request["message"]},
+            ], **request["params"]),
+        } for request in read_requests(request_file)])
+        with open(upload_file, "rb") as file:
+            uploaded = self.client.files.create(file=file, purpose="batch")
+        return self.client.batches.create(input_file_id=uploaded.id, endpoint="/v1/chat/completions",
+                                          completion_window="24h").id
+
+    def done(self, batch_id):
+        return self.client.batches.retrieve(batch_id).status in ("completed", "failed", "expired", "cancelled")
+
+    def results(self, batch_id):
+        batch = self.client.batches.retrieve(batch_id)
+        results = {}
+        for file_id in (batch.error_file_id, batch.output_file_id):
+            if file_id is None:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                response = entry.get("response") or {}
+                if response.get("status_code") == 200:
+                    results[entry["custom_id"]] = {"text": response["body"]["choices"][0]["message"]["content"]}
+                else:
+                    results[entry["custom_id"]] = {"error": json.dumps(entry.get("error") or response.get("body"))}
+        return results
+
+
+class FileBatchProvider(BatchProvider):
+    def __init__(self, directory: str, handler):
+        """
+        A local stand-in for a provider: a batch is processed on submission and its results are written next to it.
+
+        Parameters:
+        directory (str): Where batches and their results are stored.
+        handler (callable): Maps a request dict to the output text; an exception marks the request as failed.
+        """
+        self.directory = directory
+        self.handler = handler
+        os.makedirs(directory, exist_ok=True)
+
+    def submit(self, request_file):
+        batch_id = uuid.uuid4().hex
+        with open(os.path.join(self.directory, f"{batch_id}.results.jsonl"), "w") as file:
+            for request in read_requests(request_file):
+                try:
+                    result = {"text": self.handler(request)}
+                except Exception as error:
+                    result = {"error": repr(error)}
+                file.write(json.dumps({"custom_id": request["custom_id"], **result}, ensure_ascii=False) + "\n")
+        return batch_id
+
+    def done(self, batch_id):
+        return os.path.exists(os.path.join(self.directory, f"{batch_id}.results.jsonl"))
+
+    def results(self, batch_id):
+        results = {}
+        for entry in read_requests(os.path.join(self.directory, f"{batch_id}.results.jsonl")):
+            results[entry.pop("custom_id")] = entry
+        return results
+
+
+def run_batch(provider: BatchProvider, requests: list[dict], request_file: str, poll_interval: float = 60.0,
+              max_attempts: int = 3, on_poll=None) -> dict:
+    """
+    Submits requests as a batch and waits for it, resubmitting the failed ones as a new batch.
+
+    Parameters:
+    provider (BatchProvider): The batch interface to submit through.
+    requests (list): The request dicts, each with a unique custom_id.
+    request_file (str): The path the request file is written to.
+    poll_interval (float): The number of seconds between two status checks.
+    max_attempts (int): How many times a request is submitted before it is given up on.
+    on_poll (callable): Optional, called with the custom_ids still pending before every status check.
+
+    Returns:
+    dict: custom_id to output text for the requests that succeeded.
+    """
+    outputs = {}
+    pending = list(requests)
+    for attempt in range(max_attempts):
+        if not pending:
+            break
+        write_requests(request_file, pending)
+        batch_id = provider.submit(request_file)
+        print(f"submitted batch {batch_id} with {len(pending)} requests (attempt {attempt + 1})")
+        while True:
+            if on_poll is not None:
+                on_poll([request["custom_id"] for request in pending])
+            if provider.done(batch_id):
+                break
+            time.sleep(poll_interval)
+        results = provider.results(batch_id)
+        for custom_id, result in results.items():
+            if "text" in result:
+                outputs[custom_id] = result["text"]
+        pending = [request for request in pending if request["custom_id"] not in outputs]
+        if pending:
+            print(f"{len(pending)} requests failed, e.g. {results.get(pending[0]['custom_id'], 'missing')}")
+    return outputs
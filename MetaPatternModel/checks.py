@@ -0,0 +1,282 @@
+"""checks.py
+Reproducible checks of the request pipelines against local stand-ins for the providers, no API key or network needed.
+Run them from MetaPatternModel:
+
+    python checks.py pipeline --concurrency=8 --error_rate=0.2 --requests_per_minute=600
+    python checks.py prompt --max_tokens=1500
+    python checks.py batch --error_rate=0.2
+
+Every check translates the prompts of a corpus (../languages by default) in a temporary copy of it, so the corpus
+directory itself is never written to, and fails with an AssertionError if the pipeline misbehaves.
+"""
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from translation import Translator
+from journal import TranslationJournal
+from batch import FileBatchProvider
+from models import ClaudeMetaTranslator, GPT4MetaTranslator, PromptBuilder, SYSTEM_PROMPT
+
+CORPUS_FILES = ("source.txt", "target.txt", "prompts.txt")
+REPLY = "target: 1 2 3"
+
+
+class MockServer:
+    def __init__(self, error_rate: float = 0.0, latency: tuple[float, float] = (0.05, 0.2), seed: int = 0):
+        """
+        A local HTTP server answering the Anthropic messages and OpenAI chat completions endpoints.
+        Every request is recorded, and a share of them fail with a 429, 500 or 529 like an overloaded provider.
+
+        Parameters:
+        error_rate (float): The share of requests answered with an error.
+        latency (tuple): The bounds of the uniformly drawn time a request takes, in seconds.
+        seed (int): The seed of the errors and latencies.
+        """
+        self.error_rate = error_rate
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.payloads = []
+        self.started = []
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, code: int, body: dict):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(code)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["content-length"])))
+                with mock.lock:
+                    mock.payloads.append({"path": self.path, "body": payload})
+                    mock.started.append(time.monotonic())
+                    mock.in_flight += 1
+                    mock.max_in_flight = max(mock.max_in_flight, mock.in_flight)
+                    latency = mock.random.uniform(*mock.latency)
+                    code = mock.random.choice([429, 500, 529]) if mock.random.random() < mock.error_rate else 200
+                    mock.errors += code != 200
+                try:
+                    time.sleep(latency)
+                    if code != 200:
+                        self.reply(code, {"type": "error", "error": {"type": "overloaded_error", "message": "mock"}})
+                    elif "/chat" in self.path:
+                        self.reply(200, {"id": "mock", "object": "chat.completion", "created": 0, "model": "mock",
+                                         "choices": [{"index": 0, "finish_reason": "stop",
+                                                      "message": {"role": "assistant", "content": REPLY}}]})
+                    else:
+                        self.reply(200, {"id": "mock", "type": "message", "role": "assistant", "model": "mock",
+                                         "stop_reason": "end_turn", "stop_sequence": None,
+                                         "usage": {"input_tokens": 1, "output_tokens": 1},
+                                         "content": [{"type": "text", "text": REPLY}]})
+                finally:
+                    with mock.lock:
+                        mock.in_flight -= 1
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def copy_corpus(data_dir: str, directory: str) -> str:
+    for name in CORPUS_FILES:
+        shutil.copy(os.path.join(data_dir, name), directory)
+    return directory
+
+
+def check_output(translator: Translator) -> None:
+    with open(os.path.join(translator.data_dir, "output.txt"), "r") as file:
+        lines = file.read().splitlines()
+    assert len(translator.journal) == len(translator.prompts), "not every prompt was recorded in the journal"
+    assert len(lines) == len(translator.prompts), f"output.txt has {len(lines)} of {len(translator.prompts)} lines"
+
+
+def check_pipeline(args):
+    """
+    The async pipeline against a server failing a share of the requests: every prompt ends up in output.txt,
+    `concurrency` requests are in flight (not fewer, not more) and the request rate limit holds.
+    The concurrent run without errors runs without the rate limit, which would otherwise cap the requests in flight.
+    """
+    timings = {}
+    runs = ((1, 0.0, args.requests_per_minute), (args.concurrency, 0.0, None),
+            (args.concurrency, args.error_rate, args.requests_per_minute))
+    for concurrency, error_rate, requests_per_minute in runs:
+        with tempfile.TemporaryDirectory() as directory, MockServer(error_rate=error_rate, seed=args.seed) as server:
+            translator = Translator(copy_corpus(args.data_dir, directory), "mock-key", base_url=server.url,
+                                    response_cache_file=None)
+            start = time.monotonic()
+            translator.translate(concurrency=concurrency, requests_per_minute=requests_per_minute,
+                                 retries=args.retries)
+            elapsed = time.monotonic() - start
+            check_output(translator)
+            translator.journal.close()
+            assert server.max_in_flight <= concurrency, (server.max_in_flight, concurrency)
+            if requests_per_minute:
+                # a full bucket admits one burst, then requests_per_minute / 60 per second
+                burst = max(1.0, requests_per_minute / 60)
+                window = server.started[-1] - server.started[0]
+                allowed = burst + window * requests_per_minute / 60
+                assert len(server.started) <= allowed + 1, f"{len(server.started)} requests in {window:.1f}s"
+            else:
+                expected = min(concurrency, len(translator.prompts))
+                assert server.max_in_flight >= expected, f"{server.max_in_flight} of {expected} requests in flight"
+            timings[concurrency, error_rate] = elapsed
+            print(f"concurrency={concurrency:2d} error_rate={error_rate:.2f} "
+                  f"requests_per_minute={requests_per_minute}: {len(translator.prompts)} prompts, "
+                  f"{len(server.payloads)} requests ({server.errors} failed and retried), "
+                  f"at most {server.max_in_flight} in flight, {elapsed:.2f}s")
+    print(f"speedup of concurrency={args.concurrency} over sequential calls: "
+          f"{timings[1, 0.0] / timings[args.concurrency, 0.0]:.2f}x")
+
+
+def check_prompt(args):
+    """
+    The payloads the translators send: the stable prefix leads every message unchanged and carries Claude's cache
+    breakpoint, and the messages stay within the token budget.
+    """
+    with tempfile.TemporaryDirectory() as directory, MockServer() as server:
+        translator = Translator(copy_corpus(args.data_dir, directory), "mock-key", base_url=server.url,
+                                response_cache_file=None)
+        searches = translator.search_many(translator.prompts)
+        translator.journal.close()
+        for translator_class in (ClaudeMetaTranslator, GPT4MetaTranslator):
+            for max_tokens in (PromptBuilder().max_tokens, args.max_tokens):
+                del server.payloads[:]
+                prefixes, sizes, kept, total = set(), [], 0, 0
+                for prompt, (examples, _) in zip(translator.prompts, searches):
+                    model = translator_class("mock-key", base_url=server.url)
+                    builder = model.prompt_builder = PromptBuilder(max_tokens, model.prompt_builder.count_tokens)
+                    system, message, prefix = model.build_request(prompt, examples)
+                    model.translate(prompt, examples)
+                    body = server.payloads[-1]["body"]
+                    if translator_class is ClaudeMetaTranslator:
+                        assert body["system"] == system == SYSTEM_PROMPT
+                        content = body["messages"][0]["content"]
+                        assert content[0] == {"type": "text", "text": prefix, "cache_control": {"type": "ephemeral"}}
+                        assert "cache_control" not in content[1] and content[0]["text"] + content[1]["text"] == message
+                    else:
+                        assert body["messages"] == [{"role": "system", "content": system},
+                                                    {"role": "user", "content": message}]
+                    assert message.startswith(prefix)
+                    prefixes.add(prefix)
+                    pairs = PromptBuilder.split_pairs(model.preprocess(examples, prompt)[0])
+                    kept_pairs = sum(pair in message for pair in pairs)
+                    kept, total = kept + kept_pairs, total + len(pairs)
+                    size = builder.count_tokens(system) + builder.count_tokens(message)
+                    sizes.append(size)
+                    # only a prompt whose source sequence alone exceeds the budget may go over it
+                    assert size <= max_tokens or kept_pairs == 0, (size, max_tokens)
+                assert len(prefixes) == 1, "the stable prefix differs between prompts"
+                prefix_tokens = builder.count_tokens(SYSTEM_PROMPT + prefixes.pop())
+                print(f"{translator_class.__name__:20s} max_tokens={max_tokens:5d}: {len(sizes)} payloads, "
+                      f"{kept}/{total} example pairs kept, {max(sizes)} tokens at most, "
+                      f"stable prefix {prefix_tokens} tokens ({'above' if prefix_tokens >= 1024 else 'below'} "
+                      f"the 1024 token cache minimum)")
+
+
+def check_batch(args):
+    """
+    Batch mode through the file-based provider: failed requests are resubmitted until they succeed, a finished run
+    submits nothing when run again, and prompts that keep failing are released for the next run.
+    """
+    attempts, first_failures = {}, set()
+
+    def flaky(request):
+        attempts[request["custom_id"]] = attempts.get(request["custom_id"], 0) + 1
+        if attempts[request["custom_id"]] == 1 and request["custom_id"] in first_failures:
+            raise RuntimeError("mock failure")
+        return REPLY
+
+    with tempfile.TemporaryDirectory() as directory:
+        data_dir = copy_corpus(args.data_dir, directory)
+        provider = FileBatchProvider(os.path.join(directory, "batches"), flaky)
+        translator = Translator(data_dir, "mock-key")
+        n_prompts = len(translator.prompts)
+        failed = random.Random(args.seed).sample(range(n_prompts), k=max(1, round(args.error_rate * n_prompts)))
+        first_failures.update(f"prompt-{index}" for index in failed)
+        translator.translate_batch(provider, poll_interval=0.01, max_attempts=3)
+        check_output(translator)
+        translator.journal.close()
+        batches = len(os.listdir(provider.directory))
+        retried = sum(count > 1 for count in attempts.values())
+        assert retried == len(first_failures), (retried, len(first_failures))
+        print(f"{len(translator.prompts)} prompts in {batches} batches, {retried} failed requests resubmitted")
+
+        attempts.clear()
+        translator = Translator(data_dir, "mock-key")
+        translator.translate_batch(provider, poll_interval=0.01, max_attempts=3)
+        translator.journal.close()
+        assert not attempts and len(os.listdir(provider.directory)) == batches, "a finished run submitted again"
+        print("a second run finds everything in the journal and submits nothing")
+
+    failing = {"prompt-0", "prompt-3"}
+
+    def broken(request):
+        if request["custom_id"] in failing:
+            raise RuntimeError("mock failure")
+        return REPLY
+
+    with tempfile.TemporaryDirectory() as directory:
+        data_dir = copy_corpus(args.data_dir, directory)
+        translator = Translator(data_dir, "mock-key")
+        translator.translate_batch(FileBatchProvider(os.path.join(directory, "batches"), broken), poll_interval=0.01,
+                                   max_attempts=2)
+        given_up = translator.pending_prompts()
+        assert len(given_up) == len(failing), given_up
+        # a live worker in this same process, so only a release (not a dead pid or an expired claim) frees them
+        other = TranslationJournal(translator.journal.path)
+        assert all(other.claim(prompt) for prompt in given_up), "prompts given up on are still claimed"
+        other.release(given_up)
+        other.close()
+        translator.journal.close()
+        translator = Translator(data_dir, "mock-key")
+        translator.translate_batch(FileBatchProvider(os.path.join(directory, "batches"), lambda request: REPLY),
+                                   poll_interval=0.01)
+        check_output(translator)
+        translator.journal.close()
+        print(f"{len(failing)} prompts that kept failing were released, and the next run completed them")
+
+
+CHECKS = {
+    "pipeline": check_pipeline,
+    "prompt": check_prompt,
+    "batch": check_batch,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="checks of the request pipelines against local provider stand-ins")
+    parser.add_argument("check", choices=sorted(CHECKS))
+    parser.add_argument("--data_dir", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "languages"))
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--error_rate", type=float, default=0.2)
+    parser.add_argument("--requests_per_minute", type=float, default=600)
+    parser.add_argument("--retries", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max_tokens", type=int, default=1500)
+    args = parser.parse_args()
+    CHECKS[args.check](args)
@@ -0,0 +1,216 @@
+"""journal.py
+Crash-safe, resumable record of translation work.
+The journal is an append-only jsonl file keyed by a hash of the prompt, so it does not depend on the order the
+prompts happen to be sorted in. Three kinds of records are appended:
+- claim: a worker is translating a prompt, so other workers sharing the journal skip it.
+- release: the worker gave up on a prompt it claimed (e.g. the call failed), so others may take it.
+- done: the translation of a prompt together with its LAD score and rank.
+Appends happen under an exclusive file lock, which also pulls in what other workers appended in the meantime.
+Claims are flushed right away; done records are fsynced in batches, so a crash loses at most the last few.
+A claim expires after `claim_ttl` seconds unless it is renewed, or as soon as its worker process is no longer alive.
+"""
+import os
+import json
+import time
+import fcntl
+import socket
+import hashlib
+import uuid
+from contextlib import contextmanager
+
+
+def prompt_key(prompt: str) -> str:
+    return hashlib.sha1(prompt.strip().encode("utf-8")).hexdigest()
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class TranslationJournal:
+    def __init__(self, path: str, fsync_every: int = 16, fsync_interval: float = 5.0, claim_ttl: float = 3600.0):
+        """
+        Opens (or creates) a journal and reads what it already holds.
+
+        Parameters:
+        path (str): The journal file.
+        fsync_every (int): The number of done records written between two fsyncs.
+        fsync_interval (float): The maximum number of seconds a done record waits for its fsync.
+        claim_ttl (float): The number of seconds after which a claim is considered abandoned.
+        """
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.claim_ttl = claim_ttl
+        self.worker = {"host": socket.gethostname(), "pid": os.getpid(), "id": uuid.uuid4().hex}
+        self.completed = {}
+        self.claims = {}
+        self._offset = 0
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._file = open(path, "a+b")
+        with self._locked():
+            self._refresh()
+
+    @contextmanager
+    def _locked(self):
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def _refresh(self) -> None:
+        """
+        Reads the records appended since the last refresh. Must be called with the lock held.
+        """
+        self._file.seek(self._offset)
+        for line in self._file.read().splitlines(keepends=True):
+            self._offset += len(line)
+            if not line.endswith(b"\n"):
+                # torn write of a crashed worker, _append terminates it before writing after it
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record["type"] == "done":
+                self.completed[record["key"]] = record
+            elif record["type"] == "claim":
+                self.claims[record["key"]] = record
+            elif record["type"] == "release":
+                claim = self.claims.get(record["key"])
+                if claim is not None and claim["worker"]["id"] == record["worker"]["id"]:
+                    del self.claims[record["key"]]
+
+    def _append(self, record: dict) -> None:
+        """
+        Appends a record. Must be called with the lock held, after _refresh.
+        """
+        self._file.seek(0, os.SEEK_END)
+        end = self._file.tell()
+        if end:
+            self._file.seek(end - 1)
+            if self._file.read(1) != b"\n":
+                self._file.write(b"\n")
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        self._file.write(line)
+        self._file.flush()
+        self._offset = self._file.tell()
+
+    def _claim_active(self, claim: dict) -> bool:
+        if claim["worker"]["id"] == self.worker["id"]:
+            return False
+        if time.time() - claim["time"] > self.claim_ttl:
+            return False
+        if claim["worker"]["host"] == self.worker["host"] and not process_alive(claim["worker"]["pid"]):
+            return False
+        return True
+
+    def is_done(self, prompt: str) -> bool:
+        return prompt_key(prompt) in self.completed
+
+    def get(self, prompt: str):
+        """
+        Returns the done record of a prompt, or None.
+        """
+        return self.completed.get(prompt_key(prompt))
+
+    def claim(self, prompt: str) -> bool:
+        """
+        Claims a prompt for this worker. Returns False if it is already done or being worked on by another worker.
+        """
+        key = prompt_key(prompt)
+        with self._locked():
+            self._refresh()
+            if key in self.completed:
+                return False
+            claim = self.claims.get(key)
+            if claim is not None and self._claim_active(claim):
+                return False
+            record = {"type": "claim", "key": key, "worker": self.worker, "time": time.time()}
+            self._append(record)
+            self.claims[key] = record
+        return True
+
+    def _owned(self, key: str) -> bool:
+        claim = self.claims.get(key)
+        return key not in self.completed and claim is not None and claim["worker"]["id"] == self.worker["id"]
+
+    def release(self, prompts) -> None:
+        """
+        Gives up this worker's claims on prompts it has not recorded, so other workers can take them.
+        """
+        with self._locked():
+            self._refresh()
+            for key in {prompt_key(prompt) for prompt in prompts}:
+                if self._owned(key):
+                    self._append({"type": "release", "key": key, "worker": self.worker, "time": time.time()})
+                    del self.claims[key]
+
+    def renew(self, prompts) -> None:
+        """
+        Refreshes this worker's claims on prompts it is still working on, e.g. while a batch is being polled,
+        so they do not expire after claim_ttl.
+        """
+        with self._locked():
+            self._refresh()
+            for key in {prompt_key(prompt) for prompt in prompts}:
+                if self._owned(key):
+                    record = {"type": "claim", "key": key, "worker": self.worker, "time": time.time()}
+                    self._append(record)
+                    self.claims[key] = record
+
+    @contextmanager
+    def claimed(self, prompt: str):
+        """
+        Claims a prompt for the duration of the block, yielding whether the claim succeeded.
+        Unless the prompt was recorded by the end of the block, the claim is released.
+        """
+        claimed = self.claim(prompt)
+        try:
+            yield claimed
+        finally:
+            if claimed:
+                self.release([prompt])
+
+    def record(self, prompt: str, translation: str, lad: float, rank: int) -> None:
+        """
+        Records the finished translation of a prompt.
+        """
+        key = prompt_key(prompt)
+        record = {"type": "done", "key": key, "translation": translation, "lad": lad, "rank": rank,
+                  "time": time.time()}
+        with self._locked():
+            self._refresh()
+            self._append(record)
+            self.completed[key] = record
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+                self.sync()
+
+    def sync(self) -> None:
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def refresh(self) -> None:
+        """
+        Picks up the records other workers appended.
+        """
+        with self._locked():
+            self._refresh()
+
+    def close(self) -> None:
+        if not self._file.closed:
+            self.sync()
+            self._file.close()
+
+    def __len__(self):
+        return len(self.completed)
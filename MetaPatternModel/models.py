@@ -8,19 +8,35 @@ Then, it is given a new source sequence and told to convert it to a similar list
 - This should force pattern matching and work well regardless of the language.
 """
 import string
-from anthropic import Client
-from openai import OpenAI
+import sys
+from contextlib import contextmanager
+import numpy as np
+import transport
+from response_cache import ResponseCache, cache_key
+from pipeline import estimate_tokens
 
 
 class GlobalRelativeTokenizer:
     def __init__(self):
         """
         Initializes the tokenizer with default values and tokens.
+        The vocabulary is one interned string table: the list `tokens` maps a value to its token
+        and the dict `token_to_value` is the only index from a token to its value.
         """
         self.context_size = 500
-        self.token_to_value = {'<EOP>': 0}  # Assign 0 to the <EOP> token
-        self.value_to_token = {0: '<EOP>'}  # Assign <EOP> to the value 0
-        self.next_value = 1  # Start assigning values from 1
+        self.tokens = ['<EOP>']  # Assign 0 to the <EOP> token
+        self.token_to_value = {'<EOP>': 0}
+
+    @property
+    def next_value(self):
+        return len(self.tokens)
+
+    def _add(self, token):
+        value = len(self.tokens)
+        token = sys.intern(token)
+        self.tokens.append(token)
+        self.token_to_value[token] = value
+        return value
 
     def tokenize(self, text):
         """
@@ -32,15 +48,31 @@ class GlobalRelativeTokenizer:
         Returns:
         list: A list of numerical tokens representing the text.
         """
-        tokens = text.split(" ")
-        relative_tokens = []
-        for token in tokens:
-            if token not in self.token_to_value:
-                self.token_to_value[token] = self.next_value
-                self.value_to_token[self.next_value] = token
-                self.next_value += 1
-            relative_tokens.append(self.token_to_value[token])
-        return relative_tokens
+        return self.tokenize_many([text])[0].tolist()
+
+    def tokenize_many(self, texts):
+        """
+        Tokenizes several texts, values are assigned in order of first occurrence across all of them.
+
+        Parameters:
+        texts (list): The texts to be tokenized.
+
+        Returns:
+        list: An int32 array of values per text.
+        """
+        lookup = self.token_to_value.get
+        results = []
+        for text in texts:
+            tokens = text.split(" ")
+            values = list(map(lookup, tokens))
+            if None in values:
+                # only the tokens seen for the first time take the slow path
+                for position, token in enumerate(tokens):
+                    if values[position] is None:
+                        value = lookup(token)
+                        values[position] = value if value is not None else self._add(token)
+            results.append(np.array(values, dtype=np.int32))
+        return results
 
     def detokenize(self, relative_tokens):
         """
@@ -52,8 +84,58 @@ class GlobalRelativeTokenizer:
         Returns:
         str: The detokenized text.
         """
-        tokens = [self.value_to_token[value] for value in relative_tokens]
-        return ' '.join(tokens)
+        return self.detokenize_many([relative_tokens])[0]
+
+    def detokenize_many(self, sequences, default=None):
+        """
+        Converts several sequences of numerical tokens back into text.
+
+        Parameters:
+        sequences (list): The sequences, lists or arrays of numerical tokens.
+        default (str): The token of values outside the vocabulary, which raise a KeyError if None.
+
+        Returns:
+        list: The detokenized text of every sequence.
+        """
+        tokens = self.tokens
+        results = []
+        for sequence in sequences:
+            values = sequence.tolist() if isinstance(sequence, np.ndarray) else list(sequence)
+            if values and (min(values) < 0 or max(values) >= len(tokens)):
+                if default is None:
+                    raise KeyError(next(value for value in values if not 0 <= value < len(tokens)))
+                results.append(' '.join(tokens[value] if 0 <= value < len(tokens) else default for value in values))
+            else:
+                results.append(' '.join(map(tokens.__getitem__, values)))
+        return results
+
+    def snapshot(self):
+        """
+        Returns the current size of the vocabulary, to reset back to later.
+        """
+        return len(self.tokens)
+
+    def reset(self, snapshot=1):
+        """
+        Forgets every token added after a snapshot, by default everything but <EOP>.
+
+        Parameters:
+        snapshot (int): The vocabulary size returned by snapshot().
+        """
+        for token in self.tokens[snapshot:]:
+            del self.token_to_value[token]
+        del self.tokens[snapshot:]
+
+    @contextmanager
+    def scope(self):
+        """
+        Context in which tokens can be added freely; on exit the vocabulary is reset to what it was on entry.
+        """
+        snapshot = self.snapshot()
+        try:
+            yield self
+        finally:
+            self.reset(snapshot)
 
 def filter_text(text):
     """
@@ -71,17 +153,99 @@ def filter_text(text):
 
 
 
+class PromptBuilder:
+    def __init__(self, max_tokens: int = 8000, count_tokens=estimate_tokens):
+        """
+        Assembles translation prompts within a token budget.
+        The stable part of the prompt (the system prompt and the instructions) always comes first and the example
+        pairs and the source sequence follow. Providers only cache a prefix of at least 1024 tokens (2048 for the
+        smaller Claude models), which the default instructions (about 500 tokens) do not reach, so the prefix is
+        only served from the cache with longer instructions.
+
+        Parameters:
+        max_tokens (int): The token budget of the whole prompt.
+        count_tokens (callable): Counts the tokens of a text, a conservative estimate by default.
+        """
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+
+    @staticmethod
+    def split_pairs(pairs: str) -> list[str]:
+        """
+        Splits preprocessed pairs into one block per source/target pair.
+        """
+        blocks = []
+        for line in pairs.split("\n"):
+            if line.startswith("source:") or not blocks:
+                blocks.append(line)
+            else:
+                blocks[-1] += "\n" + line
+        return [block for block in blocks if block]
+
+    def build(self, system: str, pairs: str, input_prompt: str) -> tuple[str, str, str]:
+        """
+        Builds the prompt, keeping as many example pairs as fit in the budget.
+        The pairs are expected best first; a pair that does not fit is skipped and smaller ones are still tried.
+
+        Parameters:
+        system (str): The system prompt.
+        pairs (str): The preprocessed translation pairs, best first.
+        input_prompt (str): The source sequence to be translated.
+
+        Returns:
+        tuple: The system prompt, the full message and its stable prefix.
+        """
+        prefix, suffix = MESSAGE_PROMPT.split("{pairs}")
+        suffix = suffix.format(input_prompt=input_prompt)
+        budget = self.max_tokens - self.count_tokens(system) - self.count_tokens(prefix) - self.count_tokens(suffix)
+        kept = []
+        for block in self.split_pairs(pairs):
+            cost = self.count_tokens(block + "\n")
+            if cost <= budget:
+                kept.append(block)
+                budget -= cost
+        return system, prefix + "\n".join(kept) + suffix, prefix
+
+
+def openai_token_counter(model: str):
+    """
+    Returns a callable counting the tokens of a text with the tokenizer of an OpenAI model, or the conservative
+    estimate if tiktoken is not installed.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return estimate_tokens
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("o200k_base")
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
 class GPT4MetaTranslator:
-    def __init__(self, api_key: str, model: str = "gpt-4o"):
+    provider = "openai"
+
+    def __init__(self, api_key: str, model: str = "gpt-4o", base_url: str = None, max_retries: int = 2,
+                 cache: ResponseCache = None, prompt_builder: PromptBuilder = None):
         """
         Initializes the translator with API key and model.
 
         Parameters:
         api_key (str): The API key for accessing the translation service.
         model (str): The model name to be used for translation.
+        base_url (str): Optional API endpoint, e.g. a local mock server.
+        max_retries (int): The number of retries the client does by itself.
+        cache (ResponseCache): Optional persistent cache of the responses.
+        prompt_builder (PromptBuilder): Assembles the prompt within a token budget, the default budget counted with
+        the model's tokenizer (if tiktoken is installed) if None.
         """
-        self.client = OpenAI(api_key=api_key)
+        # pooled and shared with every other translator using the same key, see transport.py
+        self.client = transport.get_client(self.provider, api_key, base_url=base_url, max_retries=max_retries)
         self.model = model
+        self.cache = cache
+        self.prompt_builder = prompt_builder if prompt_builder is not None else \
+            PromptBuilder(count_tokens=openai_token_counter(model))
         self.tokenizer = GlobalRelativeTokenizer()
 
     def translate(self, input_prompt: str, pairs: str):
@@ -95,31 +259,52 @@ class GPT4MetaTranslator:
         Returns:
         str: The translated output.
         """
-        pairs, input_prompt = self.preprocess(pairs, input_prompt)
-        system = SYSTEM_PROMPT
-        message = MESSAGE_PROMPT.format(pairs=pairs, input_prompt=input_prompt)
-        output = self.send_message(message, system)
+        system, message, stable_prefix = self.build_request(input_prompt, pairs)
+        output = self.send_message(message, system, stable_prefix=stable_prefix)
         return output
 
-    def send_message(self, message, system):
+    def build_request(self, input_prompt: str, pairs: str):
+        """
+        Builds the prompt of a translation without sending it, e.g. for batch submission.
+
+        Parameters:
+        input_prompt (str): The source sequence to be translated.
+        pairs (str): The translation pairs for reference.
+
+        Returns:
+        tuple: The system prompt, the message and the stable prefix of the message.
+        """
+        pairs, input_prompt = self.preprocess(pairs, input_prompt)
+        return self.prompt_builder.build(SYSTEM_PROMPT, pairs, input_prompt)
+
+    def send_message(self, message, system, stable_prefix: str = None):
         """
         Sends a message to the translation service and retrieves the output.
 
         Parameters:
         message (str): The message to be sent.
         system (str): The system prompt.
+        stable_prefix (str): The leading part of message that is the same for every prompt.
 
         Returns:
         str: The output from the translation service.
         """
+        # OpenAI caches long shared prefixes automatically, keeping the stable part first is all it takes
+        params = SAMPLING_PARAMS
+        key = cache_key(self.provider, self.model, system, message, params)
+        if self.cache is not None:
+            output = self.cache.get(key)
+            if output is not None:
+                return output
         response = self.client.chat.completions.create(model=self.model,
         messages=[
             {"role": "system", "content": system},
             {"role": "user", "content": message}
         ],
-        temperature=0.01,
-        max_tokens=2048)
+        **params)
         output = response.choices[0].message.content
+        if self.cache is not None:
+            self.cache.put(key, output)
         return output
 
     def preprocess(self, pairs, input_prompt):
@@ -133,29 +318,39 @@ class GPT4MetaTranslator:
         Returns:
         tuple: Processed pairs and input prompt.
         """
-        lines = pairs.split("\n")
+        lines = [line for line in pairs.split("\n") if line.startswith(("source:", "target:"))]
+        targets = iter(self.tokenizer.tokenize_many(
+            [filter_text(line[len("target: "):]) for line in lines if line.startswith("target:")]))
         new_pairs = []
         for line in lines:
             if line.startswith("source:"):
                 new_pairs.append(line)
-            elif line.startswith("target:"):
-                target_text = filter_text(line[len("target: "):])
-                tokenized_target = 'target: ' + ' '.join(map(str, self.tokenizer.tokenize(target_text)))
-                new_pairs.append(tokenized_target)
+            else:
+                new_pairs.append('target: ' + ' '.join(map(str, next(targets).tolist())))
         new_pairs = "\n".join(new_pairs)
         return new_pairs, input_prompt
 
 class ClaudeMetaTranslator:
-    def __init__(self, key: str, model: str = "claude-3-opus-20240229"):
+    provider = "anthropic"
+
+    def __init__(self, key: str, model: str = "claude-3-opus-20240229", base_url: str = None, max_retries: int = 2,
+                 cache: ResponseCache = None, prompt_builder: PromptBuilder = None):
         """
         Initializes the translator with API key and model.
 
         Parameters:
         key (str): The API key for accessing the translation service.
         model (str): The model name to be used for translation.
+        base_url (str): Optional API endpoint, e.g. a local mock server.
+        max_retries (int): The number of retries the client does by itself.
+        cache (ResponseCache): Optional persistent cache of the responses.
+        prompt_builder (PromptBuilder): Assembles the prompt within a token budget, the default budget if None.
         """
-        self.client = Client(api_key=key)
+        # pooled and shared with every other translator using the same key, see transport.py
+        self.client = transport.get_client(self.provider, key, base_url=base_url, max_retries=max_retries)
         self.model = model
+        self.cache = cache
+        self.prompt_builder = prompt_builder if prompt_builder is not None else PromptBuilder()
         self.tokenizer = GlobalRelativeTokenizer()
 
     def translate(self, input_prompt: str, pairs: str):
@@ -169,33 +364,62 @@ class ClaudeMetaTranslator:
         Returns:
         str: The translated output.
         """
-        pairs, input_prompt = self.preprocess(pairs, input_prompt)
-        system = SYSTEM_PROMPT
-        message = MESSAGE_PROMPT.format(pairs=pairs, input_prompt=input_prompt)
-        output = self.send_message(message, system)
+        system, message, stable_prefix = self.build_request(input_prompt, pairs)
+        output = self.send_message(message, system, stable_prefix=stable_prefix)
         return output
 
-    def send_message(self, message, system):
+    def build_request(self, input_prompt: str, pairs: str):
+        """
+        Builds the prompt of a translation without sending it, e.g. for batch submission.
+
+        Parameters:
+        input_prompt (str): The source sequence to be translated.
+        pairs (str): The translation pairs for reference.
+
+        Returns:
+        tuple: The system prompt, the message and the stable prefix of the message.
+        """
+        pairs, input_prompt = self.preprocess(pairs, input_prompt)
+        return self.prompt_builder.build(SYSTEM_PROMPT, pairs, input_prompt)
+
+    def send_message(self, message, system, stable_prefix: str = None):
         """
         Sends a message to the translation service and retrieves the output.
 
         Parameters:
         message (str): The message to be sent.
         system (str): The system prompt.
+        stable_prefix (str): The leading part of message that is the same for every prompt.
 
         Returns:
         str: The output from the translation service.
         """
+        params = SAMPLING_PARAMS
+        key = cache_key(self.provider, self.model, system, message, params)
+        if self.cache is not None:
+            output = self.cache.get(key)
+            if output is not None:
+                return output
+        content = message
+        if stable_prefix and message.startswith(stable_prefix):
+            # a cache breakpoint after the instructions lets the system prompt and instructions be read from the
+            # prompt cache once they reach the minimum cacheable length (1024 tokens), which the default
+            # instructions do not; below it the provider ignores the breakpoint
+            content = [
+                {"type": "text", "text": stable_prefix, "cache_control": {"type": "ephemeral"}},
+                {"type": "text", "text": message[len(stable_prefix):]},
+            ]
         chat_completion = self.client.messages.create(
             model=self.model,
             system=system,
             messages=[
-                {"role": "user", "content": message}
+                {"role": "user", "content": content}
             ],
-            temperature=0.01,
-            max_tokens=2048
+            **params
         )
         output = chat_completion.content[0].text
+        if self.cache is not None:
+            self.cache.put(key, output)
         return output
 
     def preprocess(self, pairs, input_prompt):
@@ -209,15 +433,15 @@ class ClaudeMetaTranslator:
         Returns:
         tuple: Processed pairs and input prompt.
         """
-        lines = pairs.split("\n")
+        lines = [line for line in pairs.split("\n") if line.startswith(("source:", "target:"))]
+        targets = iter(self.tokenizer.tokenize_many(
+            [filter_text(line[len("target: "):]) for line in lines if line.startswith("target:")]))
         new_pairs = []
         for line in lines:
             if line.startswith("source:"):
                 new_pairs.append(line)
-            elif line.startswith("target:"):
-                target_text = filter_text(line[len("target: "):])
-                tokenized_target = 'target: ' + ' '.join(map(str, self.tokenizer.tokenize(target_text)))
-                new_pairs.append(tokenized_target)
+            else:
+                new_pairs.append('target: ' + ' '.join(map(str, next(targets).tolist())))
         new_pairs = "\n".join(new_pairs)
         return new_pairs, input_prompt
 
@@ -240,6 +464,8 @@ def extract_numbers(text):
     return []
 
 # Constants for prompts
+SAMPLING_PARAMS = {"temperature": 0.01, "max_tokens": 2048}
+
 SYSTEM_PROMPT = """You are a Translator, skilled at finding general sequence-to-sequence patterns in data. In this case, there are 'source' and 'target' sequences.
 I'll provide you with some translation pairs and your task is to generate the 'target' sequence corresponding to the given 'source' sequence.
 These are language translation pairings, but each unique word in the target has been assigned a number. Thus, the overall patterns should be linguistic in nature.
@@ -0,0 +1,181 @@
+"""pipeline.py
+Concurrency and rate limiting for translation calls.
+Most of a translation run is spent waiting on the network, so the async pipeline keeps several requests in flight.
+Token buckets cap the request and token rate, and calls that fail with a 429, a 5xx or a connection error are
+retried with jittered exponential backoff.
+"""
+import asyncio
+import functools
+import random
+import time
+import anthropic
+import openai
+
+RETRYABLE_ERRORS = (anthropic.APIConnectionError, openai.APIConnectionError)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Conservatively estimates the number of tokens of a text without a tokenizer.
+    ASCII is counted at three characters per token, other scripts at two UTF-8 bytes per token: the tokenizers merge
+    far fewer bytes of e.g. Devanagari (three bytes per character) than of English, so a characters-per-token
+    estimate would undercount them several times.
+    """
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    other_bytes = len(text.encode("utf-8")) - ascii_chars
+    return ascii_chars // 3 + other_bytes // 2 + 1
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Whether a failed call is worth retrying: rate limits, server errors and connection problems.
+    """
+    if isinstance(error, RETRYABLE_ERRORS):
+        return True
+    status_code = getattr(error, "status_code", None)
+    return status_code is not None and (status_code == 429 or status_code >= 500)
+
+
+def retry_after(error: Exception):
+    """
+    Returns the delay the server asked for in its retry-after header, or None.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Parameters:
+        rate (float): The number of tokens added per second.
+        capacity (float): The largest burst, one second worth of tokens by default.
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float = 1.0) -> None:
+        """
+        Waits until the bucket holds `amount` tokens and takes them. Requests are served in arrival order.
+        `amount` must not exceed the capacity, or the request would wait forever.
+        """
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        """
+        Limits both the request rate and the token rate; either limit can be left out.
+        """
+        # below 60 requests per minute one second's worth is less than a request, the bucket must hold a whole one
+        self.requests = TokenBucket(requests_per_minute / 60, max(1.0, requests_per_minute / 60)) \
+            if requests_per_minute else None
+        # allow a full minute of tokens as a burst, a single prompt can easily exceed one second's worth
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute) if tokens_per_minute else None
+
+    async def acquire(self, tokens: int) -> None:
+        if self.requests is not None:
+            await self.requests.acquire(1)
+        if self.tokens is not None:
+            # a prompt larger than the bucket would wait forever, it gets the whole bucket instead
+            await self.tokens.acquire(min(tokens, self.tokens.capacity))
+
+
+async def call_with_retry(function, *args, limiter: RateLimiter = None, tokens: int = 0, retries: int = 5,
+                          base_delay: float = 1.0, max_delay: float = 60.0, executor=None):
+    """
+    Runs a blocking call in a worker thread, retrying retryable failures with full-jitter exponential backoff.
+
+    Parameters:
+    function (callable): The blocking call, e.g. a MetaTranslator's translate.
+    args: The arguments of the call.
+    limiter (RateLimiter): Optional rate limiter every attempt has to pass.
+    tokens (int): The estimated token cost of one attempt.
+    retries (int): The number of retries after the first attempt.
+    base_delay (float): The backoff of the first retry in seconds, doubled on every retry.
+    max_delay (float): The largest backoff in seconds, also the cap of a delay the server asks for.
+    executor (concurrent.futures.Executor): The threads the call runs on, asyncio's default thread pool if None.
+    The default pool holds min(32, cpu_count + 4) threads, pass a pool of your own to have more calls in flight.
+
+    Returns:
+    The return value of the call.
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            await limiter.acquire(tokens)
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(function, *args))
+        except Exception as error:
+            if attempt == retries or not is_retryable(error):
+                raise
+            delay = retry_after(error)
+            if delay is None:
+                delay = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+            delay = min(max(delay, 0.0), max_delay)
+            await asyncio.sleep(delay)
+
+
+async def run_ordered(items: list, worker, write, concurrency: int = 8) -> None:
+    """
+    Runs an async worker over items with at most `concurrency` of them in flight,
+    handing the results to `write` in the order of items no matter the order they finish in.
+
+    Parameters:
+    items (list): The inputs.
+    worker (callable): An async function of (index, item).
+    write (callable): Called with (index, result) for every item, in index order.
+    concurrency (int): The number of items processed at once.
+    """
+    queue = asyncio.Queue()
+    for index, item in enumerate(items):
+        queue.put_nowait((index, item))
+    finished = {}
+    next_index = 0
+    ready = asyncio.Condition()
+
+    async def consume():
+        while True:
+            try:
+                index, item = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            result = await worker(index, item)
+            async with ready:
+                finished[index] = result
+                ready.notify_all()
+
+    async def drain():
+        nonlocal next_index
+        while next_index < len(items):
+            async with ready:
+                await ready.wait_for(lambda: next_index in finished)
+                result = finished.pop(next_index)
+            write(next_index, result)
+            next_index += 1
+
+    tasks = [asyncio.create_task(drain())]
+    tasks += [asyncio.create_task(consume()) for _ in range(max(1, min(concurrency, len(items))))]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # a failed item aborts the run, without leaving the other tasks waiting in the background
+        for task in tasks:
+            task.cancel()
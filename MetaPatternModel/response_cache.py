@@ -0,0 +1,113 @@
+"""response_cache.py
+Content-addressed, persistent cache of LLM responses.
+A response is keyed on everything that determines it: the provider, the model, the system prompt, the message and
+the sampling parameters. Re-running a crashed run, or re-scoring old translations with a different LAD setup, then
+costs nothing for the prompts that were already sent. The store is a sqlite database in WAL mode, so several
+threads and processes can read and write it at once, and the least recently used responses are evicted once it
+grows past its size limit.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+def cache_key(provider: str, model: str, system: str, message: str, params: dict) -> str:
+    """
+    Returns the content address of a request.
+    """
+    request = {"provider": provider, "model": model, "system": system, "message": message, "params": params}
+    return hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        """
+        Opens (or creates) the cache.
+
+        Parameters:
+        path (str): The sqlite database file.
+        max_bytes (int): The total size of the stored responses above which the least recently used ones are evicted.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._counter_lock = threading.Lock()
+        # sqlite connections must not be shared between threads, every thread gets its own
+        self._local = threading.local()
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS responses ("
+                           "key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        # the running total of the response sizes, so put() does not have to sum the whole table
+        connection.execute("CREATE TABLE IF NOT EXISTS meta ("
+                           "id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL)")
+        connection.execute("INSERT OR IGNORE INTO meta (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM responses")
+        connection.commit()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # wait for other writers rather than failing with "database is locked"
+            connection = sqlite3.connect(self.path, timeout=30.0)
+            self._local.connection = connection
+        return connection
+
+    def _count(self, hit: bool) -> None:
+        with self._counter_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key: str):
+        """
+        Returns the cached response of a request, or None.
+        """
+        connection = self._connection()
+        row = connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        self._count(row is not None)
+        if row is None:
+            return None
+        with connection:
+            connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+        return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        """
+        Stores a response, evicting the least recently used ones if the cache is over its size limit.
+        """
+        size = len(response.encode("utf-8"))
+        connection = self._connection()
+        # the write lock is taken up front, so the size read below cannot change before the total is updated
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            connection.execute("INSERT OR REPLACE INTO responses (key, response, size, accessed) VALUES (?, ?, ?, ?)",
+                               (key, response, size, time.time()))
+            connection.execute("UPDATE meta SET total = total + ?", (size - (row[0] if row else 0),))
+            total = connection.execute("SELECT total FROM meta").fetchone()[0]
+            if total > self.max_bytes:
+                excess = total - self.max_bytes
+                evicted = []
+                # the cursor walks the accessed index lazily, only as far as needed to get under the limit
+                for old_key, old_size in connection.execute("SELECT key, size FROM responses ORDER BY accessed"):
+                    if excess <= 0:
+                        break
+                    evicted.append((old_key,))
+                    excess -= old_size
+                connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+                connection.execute("UPDATE meta SET total = total - ?", (total - self.max_bytes - excess,))
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def __str__(self):
+        return f"ResponseCache: {len(self)} responses, {self.hits} hits, {self.misses} misses."
@@ -2,87 +2,355 @@
 Automatic translation.
 """
 import os
-from models import ClaudeMetaTranslator, GPT4MetaTranslator, extract_numbers
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from models import ClaudeMetaTranslator, GPT4MetaTranslator, extract_numbers, SAMPLING_PARAMS
 from lad import LinguisticAnomalyDetector
+from pipeline import RateLimiter, call_with_retry, run_ordered
+from response_cache import ResponseCache, cache_key
+from batch import BatchProvider, AnthropicBatchProvider, run_batch
+from journal import TranslationJournal
 from random import choices
 import numpy as np
 import tqdm
-from sklearn.feature_extraction.text import TfidfVectorizer
-import string
 from SilverPath import silver
+from SilverPath.retrievers import Retriever
 
 
 class Translator:
-    def __init__(self, data_dir: str, claude_key: str, lad_level: int = 20):
+    def __init__(self, data_dir: str, claude_key: str, lad_level: int = 20, rank_cache_file: str = "rank_cache.jsonl",
+                 retriever="tfidf", ann: bool = False, n_probe: int = 8, base_url: str = None,
+                 response_cache_file: str = "response_cache.sqlite", journal_file: str = "journal.jsonl"):
         self.data_dir = data_dir
-        self.source_texts = self.load_text_file("source.txt")
-        self.target_texts = self.load_text_file("target.txt")
-        self.silver = silver.SilverPath(data_dir=data_dir, max_rank=100)
-        self.silver.source_texts = self.source_texts
-        self.silver.target_texts = self.target_texts
+        # ranks computed for the prompt sort below are reused by search() and, through the cache file, across restarts
+        self.silver = silver.SilverPath(data_dir=data_dir, max_rank=100, cache_file=rank_cache_file, retriever=retriever,
+                                        ann=ann, n_probe=n_probe)
+        # one persisted index serves both classes: the corpus is read and vectorized once, not once per class and run
+        self.index = self.silver.index
 
         assert len(self.source_texts) == len(self.target_texts), "The texts must have the same lengths"
-        self.vectorizer = TfidfVectorizer()
-        self.vectorizer.fit(self.source_texts)
         
         self.prompts = self.silver.order_prompts_based_on_rank()
         self.claude_key = claude_key
+        self.base_url = base_url
+        # prompts already sent in an earlier (possibly crashed) run are answered from disk instead of the paid API
+        self.response_cache = ResponseCache(os.path.join(data_dir, response_cache_file)) if response_cache_file else None
+        # the record of finished prompts, keyed by prompt rather than position, that runs resume from
+        journal_path = os.path.join(data_dir, journal_file)
+        fresh = not os.path.exists(journal_path)
+        self.journal = TranslationJournal(journal_path)
+        output_file = os.path.join(data_dir, "output.txt")
+        if fresh and os.path.exists(output_file):
+            # output.txt is rendered from the journal from now on, keep what earlier runs appended to it
+            self.keep_old_output(output_file)
         lad_indices = choices(range(len(self.source_texts)), k=lad_level)
         self.linguistic_anomaly_detector = LinguisticAnomalyDetector(source_reference=[self.source_texts[i] for i in lad_indices],
                                                                      target_reference=[self.target_texts[i] for i in lad_indices])
     
-    def load_text_file(self, file_name: str) -> list[str]:
-        file_path = os.path.join(self.data_dir, file_name)
-        with open(file_path, "r") as file:
-            return [line.strip().lower().translate(str.maketrans('', '', string.punctuation)) for line in file]
-    
-    def translate(self, resume_from: int = 0) -> None:
+    @property
+    def source_texts(self) -> list[str]:
+        return self.index.source_texts
+
+    @property
+    def target_texts(self) -> list[str]:
+        return self.index.target_texts
+
+    @property
+    def retriever(self) -> Retriever:
+        return self.index.retriever
+
+    def translate(self, concurrency: int = None, **pipeline_options) -> None:
+        """
+        Translates the prompts in rank order, recording every result in the journal and rendering output.txt from it.
+        Prompts the journal already holds are skipped, so a crashed or stopped run is resumed by just running again,
+        and prompts claimed by other workers sharing the journal are left to them.
+
+        Parameters:
+        concurrency (int): If given, run the async pipeline with this many requests in flight,
+        pipeline_options are then passed on to translate_async.
+        """
+        if concurrency is not None:
+            asyncio.run(self.translate_async(concurrency=concurrency, **pipeline_options))
+            return
+        try:
+            for prompt in tqdm.tqdm(self.pending_prompts()):
+                # a prompt that fails is released again, so other workers (or the next run) can take it
+                with self.journal.claimed(prompt) as claimed:
+                    if not claimed:
+                        continue
+                    examples, rank = self.search(prompt)
+                    translator = ClaudeMetaTranslator(self.claude_key, base_url=self.base_url,
+                                                      cache=self.response_cache)
+                    translation = translator.translate(prompt, pairs=examples)
+                    text = self.decode(translator, translation)
+                    self.complete(prompt, text, rank)
+                    print("Text: ", text)
+        finally:
+            self.write_output()
+
+    async def translate_async(self, concurrency: int = 8, requests_per_minute: float = None,
+                              tokens_per_minute: float = None, retries: int = 5) -> None:
+        """
+        Translates the prompts with several requests in flight, recording every result in the journal.
+
+        Parameters:
+        concurrency (int): The number of requests in flight.
+        requests_per_minute (float): Optional request rate limit.
+        tokens_per_minute (float): Optional prompt token rate limit, counted with the translator's token counter.
+        retries (int): The number of retries of a request failing with a 429, a 5xx or a connection error.
+        """
+        prompts = self.pending_prompts()
+        searches = self.search_many(prompts)
+        limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        # the blocking calls get a thread each, asyncio's default pool would cap them at min(32, cpu_count + 4)
+        executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+        progress = tqdm.tqdm(total=len(prompts))
+
+        claimed = []
+
+        async def worker(index, prompt):
+            if not self.journal.claim(prompt):
+                return None
+            claimed.append(prompt)
+            examples, rank = searches[index]
+            # a translator per prompt, as its tokenizer has to start empty for every prompt;
+            # the API client and its connections are pooled and shared between them
+            translator = ClaudeMetaTranslator(self.claude_key, base_url=self.base_url, max_retries=0,
+                                              cache=self.response_cache)
+            # built once, so the token bucket is charged for exactly what is sent on every attempt
+            system, message, stable_prefix = translator.build_request(prompt, examples)
+            count_tokens = translator.prompt_builder.count_tokens
+            tokens = count_tokens(system) + count_tokens(message)
+            translation = await call_with_retry(translator.send_message, message, system, stable_prefix,
+                                                limiter=limiter, tokens=tokens, retries=retries, executor=executor)
+            return self.decode(translator, translation), rank
+
+        def write(index, result):
+            if result is not None:
+                self.complete(prompts[index], *result)
+            progress.update(1)
+
+        try:
+            await run_ordered(prompts, worker, write, concurrency=concurrency)
+        finally:
+            # prompts that failed, or finished but were not written before another one failed, are released
+            self.journal.release(claimed)
+            executor.shutdown(wait=False)
+            progress.close()
+            self.write_output()
+
+    def translate_batch(self, provider: BatchProvider = None, poll_interval: float = 60.0,
+                        max_attempts: int = 3) -> None:
+        """
+        Translates the prompts through a provider batch interface instead of one synchronous call per prompt.
+        Prompts already in the journal or the response cache are not submitted, and prompts that still fail after
+        max_attempts are left for the next run.
+
+        Parameters:
+        provider (BatchProvider): The batch interface, Anthropic's message batches by default.
+        poll_interval (float): The number of seconds between two status checks.
+        max_attempts (int): How many times a failing prompt is submitted.
+        """
+        prompts = [prompt for prompt in self.pending_prompts() if self.journal.claim(prompt)]
+        try:
+            self._translate_batch(prompts, provider, poll_interval, max_attempts)
+        finally:
+            # the prompts the batch gave up on are released for the next run or another worker
+            self.journal.release(prompts)
+            self.write_output()
+
+    def _translate_batch(self, prompts: list[str], provider: BatchProvider, poll_interval: float,
+                         max_attempts: int) -> None:
+        searches = self.search_many(prompts)
+        translators, requests, keys, outputs = [], [], {}, {}
+        for index, (prompt, (examples, rank)) in enumerate(zip(prompts, searches)):
+            # the translator is kept until its results are decoded, its tokenizer holds the target vocabulary
+            translator = ClaudeMetaTranslator(self.claude_key, base_url=self.base_url)
+            translators.append(translator)
+            system, message, stable_prefix = translator.build_request(prompt, examples)
+            custom_id = f"prompt-{index}"
+            keys[custom_id] = cache_key(translator.provider, translator.model, system, message, SAMPLING_PARAMS)
+            cached = self.response_cache.get(keys[custom_id]) if self.response_cache is not None else None
+            if cached is not None:
+                outputs[custom_id] = cached
+                continue
+            requests.append({"custom_id": custom_id, "model": translator.model, "system": system, "message": message,
+                             "stable_prefix": stable_prefix, "params": SAMPLING_PARAMS})
+
+        if requests:
+            provider = provider if provider is not None else AnthropicBatchProvider(translators[0].client)
+            request_file = os.path.join(self.data_dir, "batch_requests.jsonl")
+            renewed = time.monotonic()
+
+            def on_poll(custom_ids):
+                # a batch can take up to a day, keep the claims of its prompts from expiring meanwhile
+                nonlocal renewed
+                if time.monotonic() - renewed >= self.journal.claim_ttl / 4:
+                    self.journal.renew([prompts[int(custom_id.split("-")[1])] for custom_id in custom_ids])
+                    renewed = time.monotonic()
+
+            results = run_batch(provider, requests, request_file, poll_interval=poll_interval, max_attempts=max_attempts,
+                                on_poll=on_poll)
+            for custom_id, output in results.items():
+                if self.response_cache is not None:
+                    self.response_cache.put(keys[custom_id], output)
+                outputs[custom_id] = output
+
+        for index, (prompt, translator) in enumerate(zip(prompts, translators)):
+            custom_id = f"prompt-{index}"
+            if custom_id in outputs:
+                self.complete(prompt, self.decode(translator, outputs[custom_id]), searches[index][1])
+        failed = len(prompts) - len(outputs)
+        if failed:
+            print(f"{failed} prompts failed, run again once the provider recovers")
+
+    @staticmethod
+    def keep_old_output(output_file: str) -> None:
+        """
+        Moves an output file written before the journal existed aside, to the first free output.txt.old[.n].
+        Never overwrites an earlier copy, and another worker moving the file first is fine.
+        """
+        suffix = 0
+        while True:
+            backup = output_file + ".old" + (f".{suffix}" if suffix else "")
+            try:
+                # link fails instead of overwriting, unlike rename
+                os.link(output_file, backup)
+            except FileExistsError:
+                suffix += 1
+                continue
+            except FileNotFoundError:
+                return
+            break
+        try:
+            os.unlink(output_file)
+        except FileNotFoundError:
+            pass
+
+    def pending_prompts(self) -> list[str]:
+        """
+        Returns the prompts, in rank order, that the journal holds no translation of yet.
+        """
+        self.journal.refresh()
+        return [prompt for prompt in self.prompts if not self.journal.is_done(prompt)]
+
+    def complete(self, prompt: str, text: str, rank: int) -> None:
+        """
+        Scores a finished translation and records it in the journal.
+        """
+        score = self.linguistic_anomaly_detector.detect(text, prompt)
+        self.journal.record(prompt, text, score, rank)
+
+    def write_output(self) -> None:
+        """
+        Renders the journal to output.txt, one line per prompt in rank order, up to the first prompt not done yet.
+        The file is replaced atomically, so workers sharing the journal can all render it.
+        """
+        self.journal.sync()
+        self.journal.refresh()
         output_file = os.path.join(self.data_dir, "output.txt")
-        with open(output_file, "a") as file:
-            for i in tqdm.tqdm(range(resume_from, len(self.prompts))):
-                prompt = self.prompts[i]
-                examples, rank = self.search(prompt)
-                translator = ClaudeMetaTranslator(self.claude_key)
-                translation = translator.translate(prompt, pairs=examples)
-
-                sequence = extract_numbers(translation)
-                tokens = [translator.tokenizer.value_to_token.get(int(num), '[unclear]') for num in sequence]
-                text = " ".join(tokens)
-                score = self.linguistic_anomaly_detector.detect(text, prompt)
-                file.write(f"{text} Lad: {score} Rank: {rank} Combined: {score*rank}\n")
-                print("Text: ", text)
-
-    def search(self, query: str) -> str:
-        results = ""
-        n = self.silver.search(query=query)
+        temporary_file = f"{output_file}.{os.getpid()}.tmp"
+        with open(temporary_file, "w") as file:
+            for prompt in self.prompts:
+                record = self.journal.get(prompt)
+                if record is None:
+                    break
+                file.write(self.format_result(record))
+        os.replace(temporary_file, output_file)
+
+    def decode(self, translator, translation: str) -> str:
+        sequence = [int(num) for num in extract_numbers(translation)]
+        return translator.tokenizer.detokenize_many([sequence], default='[unclear]')[0]
+
+    def format_result(self, record: dict) -> str:
+        text, score, rank = record["translation"], record["lad"], record["rank"]
+        return f"{text} Lad: {score} Rank: {rank} Combined: {score*rank}\n"
+
+    def search(self, query: str) -> tuple[str, int]:
+        (examples, n), = self.search_many([query])
         print("n: ", n)
-        for _ in range(n):
-            query_vector = self.vectorizer.transform([query])
-            cosine_similarities = np.dot(query_vector, self.vectorizer.transform(self.source_texts).T).toarray().flatten()            
-            most_similar_indices = np.argpartition(cosine_similarities, -2)[-3:]
-            for index in most_similar_indices:
-                source_text = self.source_texts[index]
-                target_text = self.target_texts[index]
-                results += f"source: {source_text}\ntarget: {target_text}\n"
-
-            query_words = set(query.split())
-            for index in most_similar_indices:
-                similar_words = set(self.source_texts[index].split())
-                query_words -= similar_words
-
-            query = ' '.join(query_words)
-            if not query:
-                break
-        return results.strip(), n
+        return examples, n
+
+    def search_many(self, queries: list[str]) -> list[tuple[str, int]]:
+        """
+        Builds the example pairs for many queries at once, with as many retrieval hops as their silver rank.
+
+        Parameters:
+        queries (list): The prompts to find examples for.
+
+        Returns:
+        list: A (examples, rank) tuple per query, examples being the formatted source/target pairs.
+        """
+        ranks = [self.silver.search(query=query) for query in queries]
+        results = self.retrieve(queries, ranks)
+        return [(self.format_examples(examples), rank) for examples, rank in zip(results, ranks)]
+
+    def retrieve(self, queries: list[str], hops, k: int = 3, batch_size: int = 256) -> list[list[tuple[int, float]]]:
+        """
+        Multi-hop example retrieval. Each hop takes the k reference lines most similar to the words of the query
+        that earlier hops have not covered yet; a line is returned at most once per query.
+        With SilverPath's ann option on, the lines are looked up in its approximate nearest-neighbour index.
+
+        Parameters:
+        queries (list): The queries to retrieve examples for.
+        hops (int or list): The maximum number of hops, either shared or one per query.
+        k (int): The number of lines taken per hop.
+        batch_size (int): The number of queries scored against the corpus in one sparse product.
+
+        Returns:
+        list: Per query, the (line index, similarity) of every retrieved line in retrieval order.
+        """
+        if isinstance(hops, int):
+            hops = [hops] * len(queries)
+        results = [[] for _ in queries]
+        seen = [set() for _ in queries]
+        residual = [set(query.split()) for query in queries]
+        active = [i for i, query in enumerate(queries) if hops[i] > 0 and residual[i]]
+        hop = 0
+        while active:
+            next_active = []
+            for start in range(0, len(active), batch_size):
+                batch = active[start:start + batch_size]
+                query_matrix = self.retriever.transform([' '.join(residual[i]) for i in batch])
+                if self.silver.ann:
+                    # ask for enough lines that k unseen ones remain after dropping the seen ones
+                    hits = self.silver.ann_index.search(query_matrix, k + max(len(seen[i]) for i in batch))
+                else:
+                    similarities = (query_matrix @ self.index.matrix.T).tocsr()
+                    hits = [(similarities.indices[similarities.indptr[row]:similarities.indptr[row + 1]],
+                             similarities.data[similarities.indptr[row]:similarities.indptr[row + 1]])
+                            for row in range(len(batch))]
+                for (lines, scores), i in zip(hits, batch):
+                    if seen[i]:
+                        unseen = ~np.isin(lines, list(seen[i]))
+                        lines, scores = lines[unseen], scores[unseen]
+                    if len(lines) > k:
+                        top = np.argpartition(-scores, k - 1)[:k]
+                        lines, scores = lines[top], scores[top]
+                    # best first, ties broken by line order
+                    order = np.lexsort((lines, -scores))
+                    for line, score in zip(lines[order], scores[order]):
+                        results[i].append((int(line), float(score)))
+                        seen[i].add(int(line))
+                        residual[i] -= set(self.source_texts[line].split())
+                    # nothing left to cover, or nothing matched and the next hop would find the same nothing
+                    if residual[i] and len(lines) and hop + 1 < hops[i]:
+                        next_active.append(i)
+            active = next_active
+            hop += 1
+        return results
+
+    def format_examples(self, examples: list[tuple[int, float]]) -> str:
+        return "\n".join(f"source: {self.source_texts[index]}\ntarget: {self.target_texts[index]}" for index, _ in examples)
 
 
 def main():
     data_dir = ""
       # Directory containing source.txt, target.txt, and prompts.txt
     translator = Translator(data_dir, 'some key')
-    
-    resume_from = 0  # Index of the prompt to resume from (0 to start from the beginning)
-    translator.translate(resume_from)
+    # prompts already in the journal are skipped, just run again to resume
+    translator.translate()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,85 @@
+"""transport.py
+Pooled HTTP transport shared by the MetaTranslators.
+Building an API client per verse means a new connection pool and a new TLS handshake per verse. Instead every
+provider client is created once per (provider, key, endpoint) and all of them share one keep-alive httpx
+connection pool. httpx.Client and the SDK clients are thread-safe, so the same clients serve the sequential loop
+and the worker threads of the async pipeline.
+"""
+import threading
+import httpx
+from anthropic import Client
+from openai import OpenAI
+
+# the defaults used by get_http_client, change them with configure() before the first client is created
+POOL_OPTIONS = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30.0,
+    "timeout": 600.0,
+    "connect_timeout": 5.0,
+}
+
+_lock = threading.Lock()
+_http_clients = {}
+_clients = {}
+
+
+def configure(**options) -> None:
+    """
+    Changes the connection pool settings (max_connections, max_keepalive_connections, keepalive_expiry,
+    timeout, connect_timeout) of the clients created from now on.
+    """
+    unknown = set(options) - set(POOL_OPTIONS)
+    assert not unknown, f"Unknown transport options {unknown}"
+    POOL_OPTIONS.update(options)
+
+
+def get_http_client() -> httpx.Client:
+    """
+    Returns the shared keep-alive connection pool for the current settings.
+    """
+    key = tuple(sorted(POOL_OPTIONS.items()))
+    with _lock:
+        if key not in _http_clients:
+            _http_clients[key] = httpx.Client(
+                limits=httpx.Limits(max_connections=POOL_OPTIONS["max_connections"],
+                                    max_keepalive_connections=POOL_OPTIONS["max_keepalive_connections"],
+                                    keepalive_expiry=POOL_OPTIONS["keepalive_expiry"]),
+                timeout=httpx.Timeout(POOL_OPTIONS["timeout"], connect=POOL_OPTIONS["connect_timeout"]),
+            )
+        return _http_clients[key]
+
+
+def get_client(provider: str, api_key: str, base_url: str = None, max_retries: int = 2):
+    """
+    Returns the long-lived API client of a provider, creating it on first use.
+
+    Parameters:
+    provider (str): Either "anthropic" or "openai".
+    api_key (str): The API key of the client.
+    base_url (str): Optional API endpoint, e.g. a local mock server.
+    max_retries (int): The number of retries the client does by itself.
+
+    Returns:
+    The anthropic.Client or openai.OpenAI client.
+    """
+    assert provider in ("anthropic", "openai"), f"Unknown provider {provider}"
+    http_client = get_http_client()
+    key = (provider, api_key, base_url, max_retries, id(http_client))
+    with _lock:
+        if key not in _clients:
+            client_class = Client if provider == "anthropic" else OpenAI
+            _clients[key] = client_class(api_key=api_key, base_url=base_url, max_retries=max_retries,
+                                         http_client=http_client)
+        return _clients[key]
+
+
+def close() -> None:
+    """
+    Closes every pooled connection; clients requested afterwards get a fresh pool.
+    """
+    with _lock:
+        for http_client in _http_clients.values():
+            http_client.close()
+        _http_clients.clear()
+        _clients.clear()
@@ -2,8 +2,11 @@
 
 import string
 import os
+import sys
+import json
+import random
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
 from mingpt.model import GPT # Taken from Andrej Karpathy's MinGPT, thanks
 from mingpt.trainer import Trainer
 from mingpt.utils import set_seed, setup_logging, CfgNode as CN
@@ -17,6 +20,22 @@ def rm(text):
     translation_table = str.maketrans({key: None for key in string.punctuation if key != ':'})
     return text.translate(translation_table).lower()
 
+def read_words(path, chunk_size=1 << 20):
+    # yields the words of rm(open(path).read()).split() a chunk at a time, without reading the whole file;
+    # rm works character by character, so a word cut in two by a chunk boundary is carried over to the next chunk
+    carry = ''
+    with open(path, 'r') as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            text = carry + rm(chunk)
+            words = text.split()
+            carry = words.pop() if words and not text[-1].isspace() else ''
+            yield words
+    if carry:
+        yield [carry]
+
 def get_config():
     C = CN()
     C.system = CN()
@@ -52,23 +71,128 @@ class RelativeTokenizer:
         words = [value_to_token.get(value, 'unk') for value in relative_tokens]
         return ' '.join(words)
 
+    def global_ids(self, words):
+        # corpus-wide ids, in order of first occurrence, so windows can be sliced out of one array
+        index = {}
+        ids = np.fromiter((index.setdefault(word, len(index)) for word in words), dtype=np.int64, count=len(words))
+        return list(index), ids
+
+    def relative_window(self, ids):
+        # ids holds context_size + 1 global ids: the input window plus the word following it.
+        # Gives the same sequences as tokenize on the window: every word is numbered by the order
+        # of its first occurrence, and a following word that is not in the window gets <EOP>'s 0.
+        context = ids[:-1]
+        unique_ids, first, inverse = np.unique(context, return_index=True, return_inverse=True)
+        rank = np.empty(len(unique_ids), dtype=np.int64)
+        rank[np.argsort(first)] = np.arange(1, len(unique_ids) + 1)
+        input_seq = rank[inverse.reshape(-1)]
+        output_seq = np.empty_like(input_seq)
+        output_seq[:-1] = input_seq[1:]
+        position = np.searchsorted(unique_ids, ids[-1])
+        found = position < len(unique_ids) and unique_ids[position] == ids[-1]
+        output_seq[-1] = rank[position] if found else 0
+        return input_seq, output_seq
+
     def generate_input_output_pairs(self, text):
-        input_output_pairs = []
-        words = text.split()
-        for i in range(len(words) - self.context_size):
-            context = words[i:i + self.context_size]
-            output_words = words[i + 1:i + self.context_size + 1]
-            relative_tokens, token_to_value, value_to_token = self.tokenize(' '.join(context))
-            input_seq = relative_tokens
-            output_seq = [token_to_value.get(word, token_to_value['<EOP>']) for word in output_words]
-            input_output_pairs.append((input_seq, output_seq))
-        return input_output_pairs
+        # Slides the window one word at a time instead of re-tokenizing every window. first[w] is the
+        # position of the first occurrence of global id w in the current window (-1 if it is not in it);
+        # a word's relative id is the number of first occurrences up to and including its own.
+        vocabulary, ids = self.global_ids(text.split())
+        size = self.context_size
+        if len(ids) <= size:
+            return
+        # following[p] is the position of the next occurrence of the word at p (len(ids) if there is none)
+        order = np.argsort(ids, kind='stable')
+        same = ids[order[1:]] == ids[order[:-1]]
+        following = np.full(len(ids), len(ids), dtype=np.int64)
+        following[order[:-1][same]] = order[1:][same]
+        first = np.full(len(vocabulary), -1, dtype=np.int64)
+        unique_ids, first_positions = np.unique(ids[:size], return_index=True)
+        first[unique_ids] = first_positions
+        positions = np.arange(size)
+        for start in range(len(ids) - size):
+            first_positions = first[ids[start:start + size]] - start
+            rank = np.cumsum(first_positions == positions)
+            input_seq = rank[first_positions]
+            output_seq = np.empty_like(input_seq)
+            output_seq[:-1] = input_seq[1:]
+            incoming = ids[start + size]
+            output_seq[-1] = rank[first[incoming] - start] if first[incoming] >= 0 else 0
+            yield input_seq, output_seq
+            # the leaving word's first occurrence moves on to its next one, if that is still in the window
+            leaving = ids[start]
+            first[leaving] = following[start] if following[start] <= start + size else -1
+            if first[incoming] < 0:
+                first[incoming] = start + size
+
+class RelativeDecoder:
+    # Constrained generation over relative ids: the model may only produce the ids of words already in the
+    # context, or 0 (<EOP>). As no step can add a word, the relative vocabulary is fixed once the context is
+    # tokenized, so the id sequence just grows by the chosen id and the constraint is one cached boolean mask.
+    # With use_cache every step forwards only the newest id through GPT.step.
+    # mode is 'greedy', 'top_k' (sample among the top_k allowed ids) or 'sample'.
+    def __init__(self, model, block_size, mode='sample', top_k=None, temperature=1.0, use_cache=True):
+        assert mode in ('greedy', 'top_k', 'sample')
+        assert mode != 'top_k' or top_k is not None
+        self.model = model
+        self.tokenizer = RelativeTokenizer(block_size)
+        self.mode = mode
+        self.top_k = top_k
+        self.temperature = temperature
+        self.use_cache = use_cache
+        self.masks = {}
+
+    def mask(self, n, vocab_size, device):
+        # True for the ids 0..n-1 that may be produced
+        key = (n, vocab_size, device)
+        if key not in self.masks:
+            self.masks[key] = torch.arange(vocab_size, device=device) < n
+        return self.masks[key]
+
+    def choose(self, logits):
+        if self.mode == 'greedy':
+            return logits.argmax(dim=-1, keepdim=True)
+        logits = logits / self.temperature
+        if self.mode == 'top_k':
+            v, _ = torch.topk(logits, min(self.top_k, logits.size(-1)))
+            logits = logits.masked_fill(logits < v[:, [-1]], float('-inf'))
+        return torch.multinomial(torch.softmax(logits, dim=-1), num_samples=1)
+
+    @torch.no_grad()
+    def generate(self, text, max_new_tokens, max_words=None):
+        # returns the words generated after text, up to <EOP> or max_new_tokens words,
+        # or until text plus the generated words reach max_words words
+        relative_tokens, token_to_value, value_to_token = self.tokenizer.tokenize(text)
+        words = [value_to_token[value] for value in range(len(value_to_token))]
+        device = next(self.model.parameters()).device
+        idx = torch.tensor(relative_tokens, dtype=torch.long, device=device)[None, ...]
+        generated = []
+        past_kv = None
+        for _ in range(max_new_tokens):
+            logits, past_kv = self.model.step(idx, past_kv, use_cache=self.use_cache)
+            allowed = self.mask(len(words), logits.size(-1), device)
+            next_value = self.choose(logits.masked_fill(~allowed, float('-inf')))
+            next_token = words[next_value.item()]
+            if next_token in ['<EOP>', '<eop>']:
+                break
+            generated.append(next_token.lower())
+            idx = torch.cat((idx, next_value), dim=1)
+            if max_words is not None and idx.size(1) >= max_words:
+                break
+        return generated
 
 class RelativeTokenDataset(Dataset):
     @staticmethod
     def get_default_config():
         C = CN()
         C.block_size = 1000
+        C.corpus = '/content/data.txt'
+        # directory of prepare_shards output; when set, training reads the memory-mapped shards instead of the corpus
+        C.shard_dir = None
+        # stream the corpus (a path or a list of paths) instead of loading it, see StreamingRelativeTokenDataset
+        C.streaming = False
+        C.chunk_size = 1 << 20
+        C.shuffle_buffer = 1024
         return C
 
     def __init__(self, config, data):
@@ -76,88 +200,206 @@ class RelativeTokenDataset(Dataset):
         self.tokenizer = RelativeTokenizer(config.block_size)
         self.data = data
         self.words = data.split()
+        self.vocabulary, self.ids = self.tokenizer.global_ids(self.words)
 
     def __len__(self):
         return len(self.words) - self.config.block_size
 
     def __getitem__(self, idx):
-        context = self.words[idx:idx + self.config.block_size]
-        output_words = self.words[idx + 1:idx + self.config.block_size + 1]
-        relative_tokens, token_to_value, value_to_token = self.tokenizer.tokenize(' '.join(context))
-        input_seq = relative_tokens
-        output_seq = [token_to_value.get(word, token_to_value['<EOP>']) for word in output_words]
-        x = torch.tensor(input_seq, dtype=torch.long)
-        y = torch.tensor(output_seq, dtype=torch.long)
+        window = self.ids[idx:idx + self.config.block_size + 1]
+        input_seq, output_seq = self.tokenizer.relative_window(window)
+        x = torch.from_numpy(input_seq)
+        y = torch.from_numpy(output_seq)
+        return x, y
+
+class StreamingRelativeTokenDataset(IterableDataset):
+    # RelativeTokenDataset for corpora larger than RAM: the corpus is read a chunk at a time through read_words and
+    # only the last block_size ids plus the current chunk are held, so memory does not grow with the corpus.
+    # Every file is a document of its own, windows do not cross files. DataLoader workers take whole files
+    # round-robin when there are enough of them, otherwise every worker takes every num_workers-th window.
+    # Windows come out through a shuffle buffer of shuffle_buffer windows, as neighbouring windows overlap almost fully.
+    def __init__(self, config):
+        self.config = config
+        self.tokenizer = RelativeTokenizer(config.block_size)
+        self.paths = list(config.corpus) if isinstance(config.corpus, (list, tuple)) else [config.corpus]
+
+    def windows(self, paths, offset=0, step=1):
+        length = self.config.block_size + 1
+        position = 0
+        for path in paths:
+            # relative ids only depend on which words are equal, so the global ids can start over for every file
+            index = {}
+            ids = np.empty(0, dtype=np.int64)
+            for words in read_words(path, self.config.chunk_size):
+                new_ids = np.fromiter((index.setdefault(word, len(index)) for word in words), dtype=np.int64,
+                                      count=len(words))
+                ids = np.concatenate([ids, new_ids])
+                count = max(0, len(ids) - length + 1)
+                for start in range(count):
+                    if position % step == offset:
+                        input_seq, output_seq = self.tokenizer.relative_window(ids[start:start + length])
+                        yield torch.from_numpy(input_seq), torch.from_numpy(output_seq)
+                    position += 1
+                ids = ids[count:]
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker, workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        if len(self.paths) >= workers:
+            samples = self.windows(self.paths[worker::workers])
+        else:
+            samples = self.windows(self.paths, offset=worker, step=workers)
+        if self.config.shuffle_buffer <= 1:
+            yield from samples
+            return
+        rng = random.Random(info.seed if info is not None else None)
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.config.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+def prepare_shards(corpus, shard_dir, shard_size=1 << 24):
+    # one pass over the corpus: the global id of every word goes to int32 .npy shards of shard_size ids,
+    # the words themselves to vocabulary.txt (line i is the word of id i), and meta.json is written last
+    os.makedirs(shard_dir, exist_ok=True)
+    index = {}
+    shards = []
+    pending = []
+    pending_size = 0
+
+    def write(ids):
+        name = f'shard_{len(shards):05d}.npy'
+        np.save(os.path.join(shard_dir, name), ids)
+        shards.append({'name': name, 'size': len(ids)})
+
+    for words in read_words(corpus):
+        pending.append(np.fromiter((index.setdefault(word, len(index)) for word in words), dtype=np.int32,
+                                   count=len(words)))
+        pending_size += len(words)
+        while pending_size >= shard_size:
+            ids = np.concatenate(pending)
+            write(ids[:shard_size])
+            pending = [ids[shard_size:]]
+            pending_size -= shard_size
+    if pending_size:
+        write(np.concatenate(pending))
+    with open(os.path.join(shard_dir, 'vocabulary.txt'), 'w') as file:
+        file.writelines(word + '\n' for word in index)
+    meta = {'words': sum(shard['size'] for shard in shards), 'vocabulary_size': len(index), 'shards': shards}
+    with open(os.path.join(shard_dir, 'meta.json.tmp'), 'w') as file:
+        json.dump(meta, file)
+    os.replace(os.path.join(shard_dir, 'meta.json.tmp'), os.path.join(shard_dir, 'meta.json'))
+    print(f"wrote {meta['words']} words, {len(index)} distinct, in {len(shards)} shards to {shard_dir}")
+
+class ShardedRelativeTokenDataset(Dataset):
+    # RelativeTokenDataset over the output of prepare_shards: the shards are memory-mapped, so startup does not
+    # read the corpus and DataLoader workers share the same pages instead of each holding a copy of the words
+    def __init__(self, config):
+        self.config = config
+        self.tokenizer = RelativeTokenizer(config.block_size)
+        with open(os.path.join(config.shard_dir, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        self.shards = [np.load(os.path.join(config.shard_dir, shard['name']), mmap_mode='r') for shard in meta['shards']]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self._vocabulary = None
+
+    @property
+    def vocabulary(self):
+        if self._vocabulary is None:
+            with open(os.path.join(self.config.shard_dir, 'vocabulary.txt'), 'r') as file:
+                self._vocabulary = file.read().split('\n')[:-1]
+        return self._vocabulary
+
+    def __len__(self):
+        return max(0, int(self.offsets[-1]) - self.config.block_size)
+
+    def __getitem__(self, idx):
+        length = self.config.block_size + 1
+        shard = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+        start = idx - int(self.offsets[shard])
+        window = self.shards[shard][start:start + length]
+        # only a window crossing into the next shard(s) is copied together
+        while len(window) < length:
+            shard += 1
+            window = np.concatenate([window, self.shards[shard][:length - len(window)]])
+        input_seq, output_seq = self.tokenizer.relative_window(window)
+        x = torch.from_numpy(input_seq)
+        y = torch.from_numpy(output_seq)
         return x, y
 
-config = get_config()
-print(config)
-setup_logging(config)
-set_seed(config.system.seed)
-
-text = open('/content/data.txt', 'r').read()
-text = rm(text)
-train_dataset = RelativeTokenDataset(config.data, text)
-
-config.model.vocab_size = config.data.block_size + 1
-config.model.block_size = config.data.block_size
-model = GPT(config.model)
-
-trainer = Trainer(config.trainer, model, train_dataset)
-
-def dif(text1, text2):
-    matcher = SequenceMatcher(None, text1, text2)
-    return matcher.ratio() * 100
-
-history = []
-diff_history = []
-
-def batch_end_callback(trainer):
-    if trainer.iter_num % 10 == 0:
-        print(f"iter_dt {trainer.iter_dt * 1000:.2f}ms; iter {trainer.iter_num}: train loss {trainer.loss.item():.5f}")
-        history.append(trainer.loss.item())
-    if trainer.iter_num % 80 == 0:
-        model.eval()
-        with torch.no_grad():
-            tokenizer = RelativeTokenizer(config.data.block_size)
-            completion = context # FIXME, just define this somewhere
-            for _ in range(900):
-                relative_tokens, token_to_value, value_to_token = tokenizer.tokenize(completion)
-                x = torch.tensor(relative_tokens, dtype=torch.long)[None, ...].to(trainer.device)
-                logits = model(x)
-                logits = logits[0] if isinstance(logits, tuple) else logits
-                last_token_logits = logits[:, -1, :]
-                last_token_probs = torch.softmax(last_token_logits, dim=-1)
-                valid_token_values = list(value_to_token.keys())
-                valid_token_probs = last_token_probs[:, valid_token_values]
-                valid_token_probs /= valid_token_probs.sum(dim=-1, keepdim=True)
-                next_token_value = torch.multinomial(valid_token_probs[0], num_samples=1).item()
-                next_token = value_to_token[next_token_value]
-                if next_token in ['<EOP>', '<eop>']:
-                    break
-                completion += ' ' + next_token.lower()
-                if len(completion.split(' ')) > config.data.block_size - 100:
-                    break
-            completion = completion.split("\n")[-1].split("source:")[0]
-            print(completion)
-            print("target similarity: " + str(dif(completion, actual))) # FIXME: Also define 'actual' however
-            diff_history.append(dif(completion, actual))
-        ckpt_path = os.path.join(config.system.work_dir, "model.pt")
-        torch.save(model.state_dict(), ckpt_path)
-        model.train()
-
-trainer.set_callback('on_batch_end', batch_end_callback)
-trainer.run()
-
-x = np.arange(len(diff_history))
-plt.scatter(x, diff_history, label='Data Points')
-m, b = np.polyfit(x, diff_history, 1)
-plt.plot(x, m*x + b, color='red', label='Line of Best Fit')
-plt.xlabel('Index')
-plt.ylabel('Diff Value')
-plt.title('Diff Values with Line of Best Fit')
-plt.legend()
-plt.show()
-
-plt.plot(history)
-plt.show()
\ No newline at end of file
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 and not sys.argv[1].startswith('--') else 'train'
+    config = get_config()
+    config.merge_from_args([arg for arg in sys.argv[1:] if arg.startswith('--')])
+
+    if command == 'prepare':
+        # python gpt_example.py prepare --data.corpus=/content/data.txt --data.shard_dir=./out/shards
+        prepare_shards(config.data.corpus, config.data.shard_dir)
+        sys.exit()
+
+    print(config)
+    setup_logging(config)
+    set_seed(config.system.seed)
+
+    if config.data.shard_dir is not None:
+        train_dataset = ShardedRelativeTokenDataset(config.data)
+    elif config.data.streaming:
+        train_dataset = StreamingRelativeTokenDataset(config.data)
+    else:
+        text = open(config.data.corpus, 'r').read()
+        text = rm(text)
+        train_dataset = RelativeTokenDataset(config.data, text)
+
+    config.model.vocab_size = config.data.block_size + 1
+    config.model.block_size = config.data.block_size
+    model = GPT(config.model)
+
+    trainer = Trainer(config.trainer, model, train_dataset)
+
+    def dif(text1, text2):
+        matcher = SequenceMatcher(None, text1, text2)
+        return matcher.ratio() * 100
+
+    history = []
+    diff_history = []
+
+    def batch_end_callback(trainer):
+        if trainer.iter_num % 10 == 0:
+            print(f"iter_dt {trainer.iter_dt * 1000:.2f}ms; iter {trainer.iter_num}: train loss {trainer.loss.item():.5f}")
+            history.append(trainer.loss.item())
+        if trainer.iter_num % 80 == 0:
+            model.eval()
+            with torch.no_grad():
+                decoder = RelativeDecoder(model, config.data.block_size, mode='sample')
+                completion = context # FIXME, just define this somewhere
+                words = decoder.generate(completion, 900, max_words=config.data.block_size - 100)
+                completion += ''.join(' ' + word for word in words)
+                completion = completion.split("\n")[-1].split("source:")[0]
+                print(completion)
+                print("target similarity: " + str(dif(completion, actual))) # FIXME: Also define 'actual' however
+                diff_history.append(dif(completion, actual))
+            ckpt_path = os.path.join(config.system.work_dir, "model.pt")
+            torch.save(model.state_dict(), ckpt_path)
+            model.train()
+
+    trainer.set_callback('on_batch_end', batch_end_callback)
+    trainer.run()
+
+    x = np.arange(len(diff_history))
+    plt.scatter(x, diff_history, label='Data Points')
+    m, b = np.polyfit(x, diff_history, 1)
+    plt.plot(x, m*x + b, color='red', label='Line of Best Fit')
+    plt.xlabel('Index')
+    plt.ylabel('Diff Value')
+    plt.title('Diff Values with Line of Best Fit')
+    plt.legend()
+    plt.show()
+
+    plt.plot(history)
+    plt.show()
@@ -0,0 +1,180 @@
+"""
+Equivalence checks and CPU timings of the alternative code paths in mingpt/model.py.
+
+    python -m mingpt.bench attention --block_size=1000
+    python -m mingpt.bench generate --block_size=1000 --prompt_size=100
+    python -m mingpt.bench beam --num_beams=4 --batch_sizes 1 4 16
+    python -m mingpt.bench checkpoint --n_layer=12 --block_size=1000
+
+Every benchmark first checks that the optimized path computes the same thing as the reference
+path, then times both on the CPU.
+"""
+
+import argparse
+import time
+
+import torch
+
+from mingpt.model import GPT, CausalSelfAttention
+
+# -----------------------------------------------------------------------------
+
+def timeit(fn, repeat=5):
+    """ best wall time of fn() in seconds, after one warm-up call """
+    fn()
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+def model_config(args, **overrides):
+    config = GPT.get_default_config()
+    config.model_type = None
+    config.n_layer, config.n_head, config.n_embd = args.n_layer, args.n_head, args.n_embd
+    config.vocab_size = args.block_size + 1
+    config.block_size = args.block_size
+    config.merge_from_dict(overrides)
+    return config
+
+def bench_attention(args):
+    torch.manual_seed(0)
+    manual = CausalSelfAttention(model_config(args, attn_backend='manual'))
+    fused = CausalSelfAttention(model_config(args, attn_backend='sdpa', attn_mask_buffer=False))
+    fused.load_state_dict(manual.state_dict(), strict=False)
+    manual.eval()
+    fused.eval()
+    print(f"mask buffer per layer: {manual.bias.numel() * manual.bias.element_size() / 2**20:.1f} MiB, 0 without it")
+
+    for T in sorted({min(t, args.block_size) for t in (128, 256, 512, args.block_size)}):
+        x = torch.randn(args.batch_size, T, args.n_embd, requires_grad=True)
+
+        # equivalence: outputs and input gradients of the two paths
+        y_manual = manual(x)
+        grad_manual, = torch.autograd.grad(y_manual.sum(), x)
+        y_fused = fused(x)
+        grad_fused, = torch.autograd.grad(y_fused.sum(), x)
+        out_err = (y_manual - y_fused).abs().max().item()
+        grad_err = (grad_manual - grad_fused).abs().max().item()
+        assert out_err < 1e-4 and grad_err < 1e-3, (out_err, grad_err)
+
+        def step(module):
+            def fn():
+                module(x).sum().backward()
+            return fn
+        with torch.no_grad():
+            fwd_manual = timeit(lambda: manual(x), args.repeat)
+            fwd_fused = timeit(lambda: fused(x), args.repeat)
+        train_manual = timeit(step(manual), args.repeat)
+        train_fused = timeit(step(fused), args.repeat)
+        print(f"T={T:5d} max|dy|={out_err:.1e} max|dx|={grad_err:.1e} | "
+              f"forward manual {fwd_manual*1e3:8.2f}ms sdpa {fwd_fused*1e3:8.2f}ms ({fwd_manual/fwd_fused:.2f}x) | "
+              f"forward+backward manual {train_manual*1e3:8.2f}ms sdpa {train_fused*1e3:8.2f}ms "
+              f"({train_manual/train_fused:.2f}x)")
+
+def bench_generate(args):
+    torch.manual_seed(0)
+    model = GPT(model_config(args))
+    model.eval()
+    prompt = torch.randint(0, args.block_size + 1, (args.batch_size, args.prompt_size))
+    # past block_size the cache is dropped and every step recomputes, include a few of those steps
+    new_tokens = args.block_size - args.prompt_size + args.overflow
+
+    results = {}
+    for use_cache in (False, True):
+        t0 = time.perf_counter()
+        out = model.generate(prompt, new_tokens, use_cache=use_cache)
+        dt = time.perf_counter() - t0
+        results[use_cache] = out
+        print(f"use_cache={use_cache!s:5} {new_tokens} tokens x {args.batch_size} sequences in {dt:6.2f}s: "
+              f"{new_tokens * args.batch_size / dt:8.1f} tokens/s")
+    assert torch.equal(results[False], results[True]), "cached and uncached generation differ"
+    print("cached and uncached generation are identical")
+
+def bench_beam(args):
+    torch.manual_seed(0)
+    model = GPT(model_config(args))
+    model.eval()
+    vocab_size = args.block_size + 1
+    prompts = torch.randint(0, vocab_size, (max(args.batch_sizes), args.prompt_size))
+    # relative-token style constraint: every prompt may only produce the ids below some limit of its own
+    limits = torch.randint(2, vocab_size, (prompts.size(0), 1))
+    valid_mask = torch.arange(vocab_size).unsqueeze(0) < limits
+
+    # one beam and no constraint is greedy decoding
+    greedy = model.generate(prompts[:2], args.new_tokens)
+    seqs, _ = model.beam_search(prompts[:2], args.new_tokens, num_beams=1)
+    assert torch.equal(seqs[:, 0], greedy), "beam search with one beam differs from greedy decoding"
+    print("num_beams=1 matches greedy decoding")
+
+    for b in args.batch_sizes:
+        t0 = time.perf_counter()
+        seqs, scores = model.beam_search(prompts[:b], args.new_tokens, num_beams=args.num_beams,
+                                         valid_mask=valid_mask[:b])
+        dt = time.perf_counter() - t0
+        assert (seqs[:, :, args.prompt_size:] < limits[:b].unsqueeze(1)).all()
+        beams = b * args.num_beams
+        print(f"{b:3d} prompts x {args.num_beams} beams: {dt:6.2f}s, "
+              f"{beams * args.new_tokens / dt:8.1f} beam tokens/s, {b / dt:6.2f} prompts/s")
+
+def checkpoint_step(args, checkpoint_layers):
+    """ one training step in a fresh process: (peak rss growth in MiB, step time in s, gradients) """
+    import resource
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    torch.manual_seed(0)
+    model = GPT(model_config(args, checkpoint_layers=checkpoint_layers))
+    model.train()
+    x = torch.randint(0, args.block_size + 1, (args.batch_size, args.block_size))
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t0 = time.perf_counter()
+    torch.manual_seed(1)
+    _, loss = model(x, x)
+    loss.backward()
+    dt = time.perf_counter() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before # KiB on linux
+    return peak / 1024, dt, [p.grad for p in model.parameters()]
+
+def bench_checkpoint(args):
+    import multiprocessing
+    # the peak of a process only ever grows, so every setting is measured in a process of its own
+    context = multiprocessing.get_context('spawn')
+    settings = [None, 2, 1]
+    results = {}
+    for setting in settings:
+        with context.Pool(1) as pool:
+            results[setting] = pool.apply(checkpoint_step, (args, setting))
+    reference = results[None][2]
+    for setting in settings:
+        peak, dt, grads = results[setting]
+        err = max((a - b).abs().max().item() for a, b in zip(reference, grads))
+        assert err < 1e-5, f"checkpointed gradients differ by {err}"
+        label = {None: 'none', 1: 'every layer', 2: 'every 2nd layer'}[setting]
+        print(f"checkpoint {label:16s}: peak +{peak:8.1f} MiB, forward+backward {dt:6.2f}s, max|dgrad|={err:.1e}")
+
+BENCHMARKS = {
+    'attention': bench_attention,
+    'generate': bench_generate,
+    'beam': bench_beam,
+    'checkpoint': bench_checkpoint,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="equivalence checks and CPU timings of mingpt's model paths")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--block_size', type=int, default=1000)
+    parser.add_argument('--n_layer', type=int, default=4)
+    parser.add_argument('--n_head', type=int, default=4)
+    parser.add_argument('--n_embd', type=int, default=128)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--prompt_size', type=int, default=100)
+    parser.add_argument('--overflow', type=int, default=10)
+    parser.add_argument('--new_tokens', type=int, default=50)
+    parser.add_argument('--num_beams', type=int, default=4)
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    BENCHMARKS[args.benchmark](args)
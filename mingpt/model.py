@@ -13,6 +13,7 @@ import math
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 
 from mingpt.utils import CfgNode as CN
 
@@ -43,13 +44,30 @@ class CausalSelfAttention(nn.Module):
         # regularization
         self.attn_dropout = nn.Dropout(config.attn_pdrop)
         self.resid_dropout = nn.Dropout(config.resid_pdrop)
-        # causal mask to ensure that attention is only applied to the left in the input sequence
-        self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
-                                     .view(1, 1, config.block_size, config.block_size))
+        # attention backend: 'sdpa' is torch's fused scaled_dot_product_attention, which never materializes
+        # the (T, T) attention matrix on the paths that support it, 'manual' is the explicit implementation
+        # below and 'auto' picks sdpa whenever this version of torch has it
+        assert config.attn_backend in ('auto', 'sdpa', 'manual')
+        self.use_sdpa = config.attn_backend != 'manual' and hasattr(F, 'scaled_dot_product_attention')
+        assert self.use_sdpa or config.attn_backend != 'sdpa', "scaled_dot_product_attention needs torch >= 2.0"
+        # causal mask to ensure that attention is only applied to the left in the input sequence.
+        # it takes block_size^2 floats per layer, without it the manual path builds the mask it needs on the fly
+        # (note checkpoints saved with the buffer then need load_state_dict(strict=False))
+        if config.attn_mask_buffer:
+            self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
+                                         .view(1, 1, config.block_size, config.block_size))
+        else:
+            self.bias = None
         self.n_head = config.n_head
         self.n_embd = config.n_embd
 
-    def forward(self, x):
+    def forward(self, x, layer_past=None, use_cache=False):
+        """
+        layer_past is an optional (k, v) pair of shape (B, nh, P, hs) each, the keys and values of the P
+        positions preceding x, as returned by an earlier call with use_cache=True. x then holds positions
+        P..P+T-1 and attends to those P positions as well. With use_cache the (k, v) of all P+T positions
+        is returned along with the output.
+        """
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -57,19 +75,46 @@ class CausalSelfAttention(nn.Module):
         k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-
-        # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-        att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
-        att = F.softmax(att, dim=-1)
-        att = self.attn_dropout(att)
-        y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+        P = 0
+        if layer_past is not None:
+            P = layer_past[0].size(2)
+            k = torch.cat((layer_past[0], k), dim=2) # (B, nh, P+T, hs)
+            v = torch.cat((layer_past[1], v), dim=2) # (B, nh, P+T, hs)
+
+        if self.use_sdpa:
+            # fused causal self-attention, with the same scaling, masking and attention dropout as below.
+            # is_causal aligns the mask to the top left, which is only right without past positions;
+            # a single new position may attend to everything, several need an explicit mask
+            if P == 0:
+                attn_mask, is_causal = None, True
+            elif T == 1:
+                attn_mask, is_causal = None, False
+            else:
+                attn_mask, is_causal = ~self.causal_mask(P, T, x.device), False
+            y = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask,
+                                               dropout_p=self.attn_dropout.p if self.training else 0.0,
+                                               is_causal=is_causal)
+        else:
+            # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, P+T) -> (B, nh, T, P+T)
+            att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+            att = att.masked_fill(self.causal_mask(P, T, x.device), float('-inf'))
+            att = F.softmax(att, dim=-1)
+            att = self.attn_dropout(att)
+            y = att @ v # (B, nh, T, P+T) x (B, nh, P+T, hs) -> (B, nh, T, hs)
         y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
 
         # output projection
         y = self.resid_dropout(self.c_proj(y))
+        if use_cache:
+            return y, (k, v)
         return y
 
+    def causal_mask(self, P, T, device):
+        """ (T, P+T) mask that is True where positions P..P+T-1 must not attend """
+        if self.bias is not None:
+            return self.bias[0, 0, P:P+T, :P+T] == 0
+        return torch.ones(T, P + T, dtype=torch.bool, device=device).triu(P + 1)
+
 class Block(nn.Module):
     """ an unassuming Transformer block """
 
@@ -87,8 +132,13 @@ class Block(nn.Module):
         m = self.mlp
         self.mlpf = lambda x: m.dropout(m.c_proj(m.act(m.c_fc(x)))) # MLP forward
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, layer_past=None, use_cache=False):
+        if use_cache:
+            a, present = self.attn(self.ln_1(x), layer_past=layer_past, use_cache=True)
+            x = x + a
+            x = x + self.mlpf(self.ln_2(x))
+            return x, present
+        x = x + self.attn(self.ln_1(x), layer_past=layer_past)
         x = x + self.mlpf(self.ln_2(x))
         return x
 
@@ -110,6 +160,14 @@ class GPT(nn.Module):
         C.embd_pdrop = 0.1
         C.resid_pdrop = 0.1
         C.attn_pdrop = 0.1
+        # attention implementation, 'auto', 'sdpa' or 'manual', see CausalSelfAttention
+        C.attn_backend = 'auto'
+        # keep the block_size x block_size causal mask as a buffer in every layer
+        C.attn_mask_buffer = True
+        # activation checkpointing: the blocks whose activations are recomputed in the backward pass instead
+        # of kept from the forward pass. None for no block, an int N for every N-th block (1 is all of them)
+        # or a list of block indices
+        C.checkpoint_layers = None
         return C
 
     def __init__(self, config):
@@ -149,6 +207,16 @@ class GPT(nn.Module):
             ln_f = nn.LayerNorm(config.n_embd),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
+        if config.checkpoint_layers is None:
+            self.checkpoint_layers = set()
+        elif isinstance(config.checkpoint_layers, int):
+            assert config.checkpoint_layers > 0, \
+                "checkpoint_layers as an int is the step between checkpointed layers, it must be positive"
+            self.checkpoint_layers = set(range(0, config.n_layer, config.checkpoint_layers))
+        else:
+            self.checkpoint_layers = set(config.checkpoint_layers)
+            assert all(isinstance(i, int) and 0 <= i < config.n_layer for i in self.checkpoint_layers), \
+                "checkpoint_layers must list layer indices in [0, n_layer)"
 
         # init all weights, and apply a special scaled init to the residual projections, per GPT-2 paper
         self.apply(self._init_weights)
@@ -257,18 +325,35 @@ class GPT(nn.Module):
         optimizer = torch.optim.AdamW(optim_groups, lr=train_config.learning_rate, betas=train_config.betas)
         return optimizer
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, past_kv=None, use_cache=False):
+        """
+        past_kv is an optional list with the (k, v) cache of every layer, as returned by an earlier call
+        with use_cache=True; idx then continues that sequence. With use_cache the updated caches are
+        returned as a third value, after the logits and the loss.
+        """
         device = idx.device
         b, t = idx.size()
-        assert t <= self.block_size, f"Cannot forward sequence of length {t}, block size is only {self.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device).unsqueeze(0) # shape (1, t)
+        past = 0 if past_kv is None else past_kv[0][0].size(2)
+        assert past + t <= self.block_size, f"Cannot forward sequence of length {past + t}, block size is only {self.block_size}"
+        pos = torch.arange(past, past + t, dtype=torch.long, device=device).unsqueeze(0) # shape (1, t)
 
         # forward the GPT model itself
         tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
         pos_emb = self.transformer.wpe(pos) # position embeddings of shape (1, t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
+        presents = []
+        # checkpointing only pays off when there is a backward pass to recompute for
+        checkpointing = self.training and torch.is_grad_enabled() and not use_cache and past_kv is None
+        for i, block in enumerate(self.transformer.h):
+            if use_cache:
+                x, present = block(x, layer_past=None if past_kv is None else past_kv[i], use_cache=True)
+                presents.append(present)
+            elif checkpointing and i in self.checkpoint_layers:
+                # the block's activations are freed after the forward pass and recomputed (with the same
+                # dropout masks, the rng state is restored) when the backward pass reaches it
+                x = checkpoint(block, x, use_reentrant=False)
+            else:
+                x = block(x, layer_past=None if past_kv is None else past_kv[i])
         x = self.transformer.ln_f(x)
         logits = self.lm_head(x)
 
@@ -277,22 +362,47 @@ class GPT(nn.Module):
         if targets is not None:
             loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
 
+        if use_cache:
+            return logits, loss, presents
         return logits, loss
 
+    def step(self, idx, past_kv=None, use_cache=True):
+        """
+        Forward what is new in idx (LongTensor of shape (b,t)) for one step of decoding. past_kv is the
+        cache returned by the previous step, when idx was one token shorter (None on the first step).
+        Returns the logits at the final position, of shape (b, vocab_size), and the cache for the next step.
+        """
+        if past_kv is not None and idx.size(1) <= self.block_size:
+            # only the token appended since the previous step is new
+            assert past_kv[0][0].size(2) == idx.size(1) - 1, "past_kv does not belong to idx[:, :-1]"
+            logits, _, past_kv = self(idx[:, -1:], past_kv=past_kv, use_cache=True)
+        else:
+            # if the sequence context is growing too long we must crop it at block_size.
+            # every position then shifts by one each step, which invalidates the cached keys and
+            # values (they include the position embeddings), so from here on every step recomputes
+            idx_cond = idx if idx.size(1) <= self.block_size else idx[:, -self.block_size:]
+            if use_cache and idx.size(1) < self.block_size:
+                logits, _, past_kv = self(idx_cond, use_cache=True)
+            else:
+                logits, _ = self(idx_cond)
+                past_kv = None
+        return logits[:, -1, :], past_kv
+
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, do_sample=False, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, do_sample=False, top_k=None, use_cache=True):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        With use_cache the keys and values of earlier positions are kept, so every step only
+        forwards the newest token, until the sequence outgrows block_size.
         """
+        past_kv = None
         for _ in range(max_new_tokens):
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.block_size else idx[:, -self.block_size:]
             # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
+            logits, past_kv = self.step(idx, past_kv, use_cache=use_cache)
             # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
+            logits = logits / temperature
             # optionally crop the logits to only the top k options
             if top_k is not None:
                 v, _ = torch.topk(logits, top_k)
@@ -308,3 +418,60 @@ class GPT(nn.Module):
             idx = torch.cat((idx, idx_next), dim=1)
 
         return idx
+
+    @torch.no_grad()
+    def beam_search(self, idx, max_new_tokens, num_beams=4, valid_mask=None, eos_token=None, length_penalty=1.0,
+                    use_cache=True):
+        """
+        Batched beam search: the num_beams beams of all b prompts in idx (LongTensor of shape (b,t), so
+        prompts of different lengths go in separate calls) advance together, one forward pass per step.
+        valid_mask is an optional bool tensor of shape (b, vocab_size) of the tokens each prompt's beams
+        may produce. A beam that produces eos_token is finished: it keeps its score and only extends with
+        eos_token from then on. Beams are ranked by their summed log-probability divided by
+        (number of generated tokens up to and including eos) ** length_penalty.
+        Returns the sequences, shape (b, num_beams, t + steps), and their scores, shape (b, num_beams),
+        best first for every prompt.
+        """
+        b, t = idx.size()
+        K = num_beams
+        seqs = idx.repeat_interleave(K, dim=0) # (b*K, t), the beams of a prompt are adjacent
+        # all beams start out identical, only the first one may expand or the beams would be copies
+        scores = torch.full((b, K), float('-inf'), device=idx.device)
+        scores[:, 0] = 0.0
+        scores = scores.view(-1)
+        lengths = torch.zeros(b * K, device=idx.device)
+        finished = torch.zeros(b * K, dtype=torch.bool, device=idx.device)
+        mask = None if valid_mask is None else valid_mask.to(idx.device).repeat_interleave(K, dim=0)
+        offsets = (torch.arange(b, device=idx.device) * K).unsqueeze(1)
+        past_kv = None
+        for _ in range(max_new_tokens):
+            logits, past_kv = self.step(seqs, past_kv, use_cache=use_cache)
+            if mask is not None:
+                # renormalized over the valid tokens, as sampling under the same constraint would be
+                logits = logits.masked_fill(~mask, float('-inf'))
+            logprobs = F.log_softmax(logits.float(), dim=-1)
+            if eos_token is not None and finished.any():
+                logprobs[finished] = float('-inf')
+                logprobs[finished, eos_token] = 0.0
+            V = logprobs.size(-1)
+            # score every continuation of every beam, length-normalized, and keep the K best per prompt
+            candidates = scores.unsqueeze(1) + logprobs # (b*K, V)
+            new_lengths = lengths + (~finished).float()
+            normalized = candidates / new_lengths.unsqueeze(1) ** length_penalty
+            _, top = normalized.view(b, K * V).topk(K, dim=1) # (b, K)
+            rows = (offsets + top // V).view(-1) # the beam every survivor continues
+            tokens = (top % V).view(-1, 1)
+            scores = candidates.view(b, K * V).gather(1, top).view(-1)
+            seqs = torch.cat((seqs[rows], tokens), dim=1)
+            lengths = new_lengths[rows]
+            finished = finished[rows]
+            if eos_token is not None:
+                finished = finished | (tokens.view(-1) == eos_token)
+            if past_kv is not None:
+                past_kv = [(k[rows], v[rows]) for k, v in past_kv]
+            if finished.all():
+                break
+        normalized = (scores / lengths.clamp(min=1) ** length_penalty).view(b, K)
+        normalized, order = normalized.sort(dim=1, descending=True)
+        seqs = seqs.view(b, K, -1).gather(1, order.unsqueeze(-1).expand(-1, -1, seqs.size(1)))
+        return seqs, normalized
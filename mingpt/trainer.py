@@ -7,6 +7,7 @@ import time
 from collections import defaultdict
 
 import torch
+from torch.utils.data import IterableDataset
 from torch.utils.data.dataloader import DataLoader
 from mingpt.utils import CfgNode as CN
 
@@ -26,6 +27,13 @@ class Trainer:
         C.betas = (0.9, 0.95)
         C.weight_decay = 0.1 # only applied on matmul weights
         C.grad_norm_clip = 1.0
+        # mixed precision: None trains in fp32, 'bf16' runs the forward pass under bfloat16 autocast
+        # (on the cpu as well as on cuda), the parameters and optimizer state stay fp32
+        C.mixed_precision = None
+        # gradient accumulation: every optimizer step sums the gradients of grad_accum_steps micro-batches
+        # of batch_size examples. alternatively set effective_batch_size, the examples per optimizer step
+        C.grad_accum_steps = 1
+        C.effective_batch_size = None
         return C
 
     def __init__(self, config, model, train_dataset):
@@ -43,6 +51,16 @@ class Trainer:
         self.model = self.model.to(self.device)
         print("running on device", self.device)
 
+        assert config.mixed_precision in (None, 'bf16')
+        self.autocast = torch.autocast(device_type='cuda' if str(self.device).startswith('cuda') else 'cpu',
+                                       dtype=torch.bfloat16, enabled=config.mixed_precision == 'bf16')
+        if config.effective_batch_size is not None:
+            assert config.effective_batch_size % config.batch_size == 0, \
+                "effective_batch_size must be a multiple of batch_size"
+            self.grad_accum_steps = config.effective_batch_size // config.batch_size
+        else:
+            self.grad_accum_steps = config.grad_accum_steps
+
         # variables that will be assigned to trainer class later for logging and etc
         self.iter_num = 0
         self.iter_time = 0.0
@@ -64,10 +82,14 @@ class Trainer:
         # setup the optimizer
         self.optimizer = model.configure_optimizers(config)
 
-        # setup the dataloader
+        # setup the dataloader; an IterableDataset has no length to sample from, it orders (and splits) itself
+        if isinstance(self.train_dataset, IterableDataset):
+            sampler = None
+        else:
+            sampler = torch.utils.data.RandomSampler(self.train_dataset, replacement=True, num_samples=int(1e10))
         train_loader = DataLoader(
             self.train_dataset,
-            sampler=torch.utils.data.RandomSampler(self.train_dataset, replacement=True, num_samples=int(1e10)),
+            sampler=sampler,
             shuffle=False,
             pin_memory=True,
             batch_size=config.batch_size,
@@ -80,21 +102,30 @@ class Trainer:
         data_iter = iter(train_loader)
         while True:
 
-            # fetch the next batch (x, y) and re-init iterator if needed
-            try:
-                batch = next(data_iter)
-            except StopIteration:
-                data_iter = iter(train_loader)
-                batch = next(data_iter)
-            batch = [t.to(self.device) for t in batch]
-            x, y = batch
-
-            # forward the model
-            logits, self.loss = model(x, y)
-
-            # backprop and update the parameters
+            # one iteration is one optimizer step over grad_accum_steps micro-batches
             model.zero_grad(set_to_none=True)
-            self.loss.backward()
+            loss = 0.0
+            for _ in range(self.grad_accum_steps):
+
+                # fetch the next batch (x, y) and re-init iterator if needed
+                try:
+                    batch = next(data_iter)
+                except StopIteration:
+                    data_iter = iter(train_loader)
+                    batch = next(data_iter)
+                batch = [t.to(self.device) for t in batch]
+                x, y = batch
+
+                # forward the model
+                with self.autocast:
+                    logits, micro_loss = model(x, y)
+
+                # backprop, scaled so the accumulated gradient is that of the mean loss over the micro-batches
+                (micro_loss / self.grad_accum_steps).backward()
+                loss += micro_loss.detach() / self.grad_accum_steps
+            self.loss = loss
+
+            # update the parameters
             torch.nn.utils.clip_grad_norm_(model.parameters(), config.grad_norm_clip)
             self.optimizer.step()
 